@@ -10,4 +10,14 @@ find . -maxdepth 1 -type f -name "*jar" -exec jar -xf {} \;
 jar cvf microrts.jar *
 mv microrts.jar ../microrts.jar
 cd ..
-rm -rf build
\ No newline at end of file
+rm -rf build
+
+# optionally dump a class-data-sharing archive next to microrts.jar to speed up JVM startup (needs JDK 13+)
+if [ -n "$MICRORTS_CDS" ]; then
+    JAVA_MAJOR=$(java -version 2>&1 | head -n 1 | sed -E 's/.*version "(1\.)?([0-9]+).*/\2/')
+    if [ "$JAVA_MAJOR" -ge 13 ]; then
+        (cd ../.. && python3 -m gym_microrts.envs.jvm)
+    else
+        echo "Skipping the class-data-sharing archive, it needs JDK 13+ but found JDK $JAVA_MAJOR"
+    fi
+fi
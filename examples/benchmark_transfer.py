@@ -0,0 +1,47 @@
+"""Measures the per-step cost of moving `gameStep` results from the JVM into numpy.
+
+Compares the element by element `np.array` conversion with `java_to_numpy`, which goes
+through JPype's buffer protocol, e.g. `python -m examples.benchmark_transfer --num-envs 64`.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from gym_microrts import microrts_ai
+from gym_microrts.envs.grid_mode_vec_env import MicroRTSGridModeVecEnv
+from gym_microrts.utils import java_to_numpy
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--num-envs", type=int, default=64)
+parser.add_argument("--num-steps", type=int, default=200)
+parser.add_argument("--map-path", default="maps/16x16/basesWorkers16x16.xml")
+args = parser.parse_args()
+
+env = MicroRTSGridModeVecEnv(
+    num_selfplay_envs=0,
+    num_bot_envs=args.num_envs,
+    max_steps=2000,
+    ai2s=[microrts_ai.coacAI for _ in range(args.num_envs)],
+    map_path=args.map_path,
+)
+env.reset()
+
+def timed(convert, responses):
+    start = time.perf_counter()
+    convert(responses.observation)
+    convert(responses.reward)
+    convert(responses.done)
+    return time.perf_counter() - start
+
+before, after = [], []
+for _ in range(args.num_steps):
+    responses = env.vec_client.gameStep([[] for _ in range(env.num_envs)], [0] * env.num_envs)
+    before.append(timed(np.array, responses))
+    after.append(timed(java_to_numpy, responses))
+env.close()
+
+print(f"num_envs={args.num_envs} map={args.map_path}")
+print(f"np.array      : {np.mean(before) * 1e3:8.3f} ms/step")
+print(f"java_to_numpy : {np.mean(after) * 1e3:8.3f} ms/step")
+print(f"speedup       : {np.mean(before) / np.mean(after):8.1f}x")
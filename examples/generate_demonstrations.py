@@ -0,0 +1,30 @@
+"""Records demonstrations of workerRushAI against coacAI for imitation learning.
+
+The bot env plays the games in Java and, with `expert=True`, returns the observations,
+action masks and issued actions of the `ai1s` bots, which the recorder streams to disk.
+"""
+import numpy as np
+
+from gym_microrts import microrts_ai
+from gym_microrts.envs.bot_vec_env import MicroRTSBotVecEnv
+from gym_microrts.recording import TrajectoryReader, TrajectoryRecorder
+
+num_envs = 16
+env = MicroRTSBotVecEnv(
+    ai1s=[microrts_ai.workerRushAI for _ in range(num_envs)],
+    ai2s=[microrts_ai.coacAI for _ in range(num_envs)],
+    max_steps=2000,
+    map_path="maps/16x16/basesWorkers16x16.xml",
+    reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0]),
+    expert=True,
+)
+recorder = TrajectoryRecorder(env, "demonstrations", obs_format="planes")
+recorder.reset()
+for i in range(2000):
+    recorder.step([[] for _ in range(num_envs)])
+recorder.close()
+env.close()
+
+reader = TrajectoryReader("demonstrations")
+step = reader[100]
+print(f"{len(reader)} steps of {num_envs} envs, {int((step['actions'][..., 0] > 0).sum())} units acted in step 100")
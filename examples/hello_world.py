@@ -28,7 +28,7 @@ nvec = env.action_space.nvec
 for i in range(10000):
     env.render()
     actions = []
-    action_mask = np.array(env.vec_client.getMasks(0))[0] # (16, 16, 79)
+    action_mask = env.get_action_mask()[0] # (16, 16, 79)
     action_mask = action_mask.reshape(-1, action_mask.shape[-1]) # (256, 79)
     source_unit_mask = action_mask[:,[0]] # (256, 1)
     for source_unit in np.where(source_unit_mask == 1)[0]:
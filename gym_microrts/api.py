@@ -1,20 +1,91 @@
+import asyncio
+import json
 import logging
-from typing import Any, Dict, Optional, Union
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
 
-from fastapi import FastAPI, HTTPException
+import numpy as np
+from fastapi import (Depends, FastAPI, Header, HTTPException, Request,
+                     Response, WebSocket)
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from starlette.routing import Match
 
 from gym_microrts.envs import MicroRTSBotVecEnv, MicroRTSGridModeVecEnv
 from gym_microrts.microrts_ai import coacAI
+from gym_microrts.pool import EnvPool, PoolSlot
+from gym_microrts.serialization import (BINARY_TYPES, JSON, MSGPACK, NPZ,
+                                        OBS_FORMATS, DeltaEncoder,
+                                        actions_from_array, decode_actions,
+                                        decode_arrays, encode_arrays,
+                                        encode_observation, negotiate)
+from gym_microrts.sessions import Session, SessionLimitError, SessionRegistry
+from gym_microrts.stats import PhaseTimer, prometheus_histograms
 from gym_microrts.types import (ActionType, EnvActionType, EnvStepType,
                                 ObservationType, StepType)
 from gym_microrts.utils import extract_space_info, to_list, to_numpy
 
 app = FastAPI(title="Gym MicroRTS")
-Environment = Union[MicroRTSGridModeVecEnv, MicroRTSBotVecEnv]
-env: Optional[Environment] = None
+Environment = Union[MicroRTSGridModeVecEnv, MicroRTSBotVecEnv, PoolSlot]
 
-last_step: Optional[StepType] = None
-last_actions: Optional[ActionType] = None
+# Environment used by the routes without an ID, e.g. `/env/step`.
+DEFAULT_ENV_ID = "default"
+registry = SessionRegistry(
+    max_sessions=int(os.environ.get("MICRORTS_MAX_SESSIONS", 8)),
+    idle_timeout=float(os.environ.get("MICRORTS_SESSION_IDLE_TIMEOUT", 900)),
+)
+
+# Environments created with `"pooled": true` are slots of a shared vectorized environment
+# whose concurrent steps are coalesced into a single `gameStep`. Configs that differ in
+# anything but `pooled` get their own pool.
+POOL_SIZE = int(os.environ.get("MICRORTS_POOL_SIZE", 16))
+POOL_WINDOW = float(os.environ.get("MICRORTS_POOL_WINDOW", 0.005))
+pools: Dict[str, EnvPool] = {}
+pool_lock = threading.Lock()
+
+# Phase timers of the environments are off unless `MICRORTS_INSTRUMENT` is set or a config
+# passes `"instrument": true`, request latencies are always recorded. Both are served at `/metrics`.
+INSTRUMENT = os.environ.get("MICRORTS_INSTRUMENT", "").lower() in ("1", "true", "yes")
+request_stats = PhaseTimer()
+
+# Clients asking for delta observations get a full keyframe at least every this many frames.
+KEYFRAME_INTERVAL = int(os.environ.get("MICRORTS_KEYFRAME_INTERVAL", 100))
+
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    request_stats.observe((request.method, route_path(request)), time.perf_counter() - start)
+    return response
+
+
+def route_path(request: Request) -> str:
+    "Returns the path template of the matched route, so that env IDs don't become labels."
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+@app.on_event("startup")
+async def start_idle_eviction():
+    "Periodically closes environments that were not used for the idle timeout."
+    async def evict_idle():
+        while True:
+            await asyncio.sleep(min(60.0, registry.idle_timeout / 2))
+            await run_in_threadpool(registry.evict_idle)
+    asyncio.get_event_loop().create_task(evict_idle())
+
+
+@app.on_event("shutdown")
+def close_sessions():
+    registry.close_all()
+    for pool in pools.values():
+        pool.close()
 
 
 @app.get("/ping")
@@ -23,9 +94,22 @@ def ping():
     return "pong"
 
 
-@app.post("/env", status_code=201)
-def init_env(config: Optional[Dict[str, Any]] = None):
-    global env
+@app.get("/metrics")
+def metrics() -> Response:
+    """Request latencies per route and, for instrumented environments, their phase timings
+    in the Prometheus text format. The shared pools are reported as `env_id="pool-<n>"`."""
+    envs = [(session.env_id, session.env) for session in registry.sessions() if not isinstance(session.env, PoolSlot)]
+    envs.extend((f"pool-{n}", pool.env) for n, pool in enumerate(pools.values()))
+    requests = [({"method": method, "route": route}, histogram) for (method, route), histogram in request_stats.histograms()]
+    phases = [({"env_id": env_id, "phase": phase}, histogram) for env_id, env in envs for phase, histogram in env.stats.histograms()]
+    content = (
+        prometheus_histograms("microrts_http_request_duration_seconds", "Latency of HTTP requests by route.", requests)
+        + prometheus_histograms("microrts_env_phase_duration_seconds", "Duration of the phases of reset, step and render by environment.", phases)
+    )
+    return Response(content=content, media_type="text/plain; version=0.0.4")
+
+
+def make_env(config: Optional[Dict[str, Any]] = None) -> Environment:
     config = config or {}
     env_name = config.get("env_name")
     if env_name is None or env_name != "BotVecEnv":
@@ -40,109 +124,414 @@ def init_env(config: Optional[Dict[str, Any]] = None):
 
         reward_weight = config.get("reward_weight", [10.0, 1.0, 1.0, 0.2, 1.0, 4.0])
         assert len(reward_weight) == 6, "Reward weight is a list of 6 values"
-        env = MicroRTSGridModeVecEnv(
+        return MicroRTSGridModeVecEnv(
             num_selfplay_envs=num_selfplay_evs,
             num_bot_envs=num_bot_envs,
             max_steps=max_steps,
             ai2s=ai2s,
             map_path=map_path,
-            reward_weight=to_numpy(reward_weight)
+            reward_weight=to_numpy(reward_weight),
+            instrument=config.get("instrument", INSTRUMENT),
         )
     else:
-        env = MicroRTSBotVecEnv()
+        return MicroRTSBotVecEnv(instrument=config.get("instrument", INSTRUMENT))
+
+
+def acquire_pool_slot(config: Dict[str, Any]) -> PoolSlot:
+    """Hands out a slot of the pool of `config`, which is built on its first use.
+    Raises:
+        HTTPException if all slots are taken.
+    """
+    key = json.dumps({k: v for k, v in config.items() if k != "pooled"}, sort_keys=True)
+    with pool_lock:
+        pool = pools.get(key)
+        if pool is None:
+            pool_config = dict(config, num_selfplay_envs=0, num_bot_envs=POOL_SIZE)
+            pool = pools[key] = EnvPool(make_env(pool_config), window=POOL_WINDOW)
+    try:
+        return pool.acquire()
+    except IndexError as e:
+        raise HTTPException(429, str(e))
+
+
+def create_session(config: Optional[Dict[str, Any]], env_id: Optional[str] = None) -> Session:
+    """Builds an environment from `config` and registers it.
+    Raises:
+        HTTPException if the maximum number of environments is reached.
+    """
+    registry.evict_idle()
+    if len(registry) >= registry.max_sessions and env_id not in registry.ids():
+        raise HTTPException(429, f"Maximum number of {registry.max_sessions} environments reached")
+    config = config or {}
+    env = acquire_pool_slot(config) if config.get("pooled") else make_env(config)
+    try:
+        return registry.create(env, env_id)
+    except SessionLimitError as e:
+        env.close(shutdown_jvm=False)
+        raise HTTPException(429, str(e))
+
+
+@app.post("/env", status_code=201)
+def init_env(config: Optional[Dict[str, Any]] = None):
+    "Create the default environment used by the `/env/...` routes without an ID."
+    create_session(config, DEFAULT_ENV_ID)
+    return {"env_id": DEFAULT_ENV_ID}
+
+
+@app.post("/envs", status_code=201)
+def init_session_env(config: Optional[Dict[str, Any]] = None):
+    "Create an additional environment, use the returned ID in `/env/{env_id}/...` routes."
+    return {"env_id": create_session(config).env_id}
+
+
+@app.get("/envs")
+def list_envs() -> List[str]:
+    return registry.ids()
+
+
+@app.delete("/env/{env_id}")
+def delete_env(env_id: str) -> None:
+    "Close the environment and free its slot."
+    try:
+        registry.remove(env_id)
+    except KeyError:
+        raise HTTPException(404, f"Environment '{env_id}' does not exist")
+    return None
+
+
+class OutputFormat:
+    """Response encoding negotiated from the `Accept` header and query parameters.
+
+    JSON is the default. Binary responses (`application/x-npz`, `application/msgpack`)
+    send observations as `uint8` or bit-packed (`obs_format=packed`) and can be
+    compressed with `compress=true`.
+
+    With `delta=true` binary responses only hold the cells that changed since frame `ack`,
+    the `frame_id` of the last observation the client decoded, see `DeltaEncoder`. Resets,
+    unknown `ack`s and `keyframe=true` get the full observation.
+    """
+    def __init__(
+        self,
+        accept: Optional[str] = Header(None),
+        obs_format: str = "uint8",
+        compress: bool = False,
+        delta: bool = False,
+        ack: Optional[int] = None,
+        keyframe: bool = False,
+    ):
+        if obs_format not in OBS_FORMATS:
+            raise HTTPException(400, f"obs_format must be one of {OBS_FORMATS}")
+        self.media_type = negotiate(accept)
+        if delta and self.media_type == JSON:
+            raise HTTPException(406, "Delta observations need a binary format")
+        self.obs_format = obs_format
+        self.compress = compress
+        self.delta = delta
+        self.ack = ack
+        self.keyframe = keyframe
+
+
+async def read_env_action(request: Request, commit: bool = True) -> EnvActionType:
+    """Parses actions sent either as JSON `EnvActionType` or in a binary format.
+
+    Binary bodies (`application/x-npy`, `application/x-npz`, `application/msgpack`) hold an
+    `actions` array, the commit flag is then passed as a query parameter.
+    """
+    media_type = request.headers.get("content-type", JSON).split(";")[0].strip()
+    body = await request.body()
+    if media_type not in BINARY_TYPES:
+        try:
+            return EnvActionType.parse_raw(body)
+        except ValidationError as e:
+            raise HTTPException(422, e.errors())
+    try:
+        actions = decode_actions(body, media_type, request.headers.get("content-encoding"))
+    except (ValueError, KeyError, OSError) as e:
+        raise HTTPException(415, str(e))
+    return EnvActionType.construct(actions=actions, commit=commit)
+
+
+def reset_session(session: Session, seed: Optional[int], output: OutputFormat) -> ObservationType:
+    env = session.env
+    with session.lock:
+        if seed:
+            env.seed(seed)
+        observation = env.reset()
+        if output.media_type == JSON:
+            return to_list(observation)
+        return binary_response(observation_arrays(session, observation, output, keyframe=True), output)
+
+
+def step_session(session: Session, env_action: EnvActionType, output: OutputFormat) -> Optional[EnvStepType]:
+    with session.lock:
+        session.last_actions = env_action.actions
+
+        if env_action.commit:
+            session.last_step = commit(session.env, session.last_actions)
+            return step_response(session, session.last_step, output)
+
+    return None
+
+
+def commit_session(session: Session, output: OutputFormat) -> EnvStepType:
+    with session.lock:
+        if session.last_actions is None:
+            raise HTTPException(400, "Cannot commit action without passing action. Please use `/env/step` first.")
+        session.last_step = commit(session.env, session.last_actions)
+        # Clear action after commiting
+        session.last_actions = None
+        return step_response(session, session.last_step, output)
+
+
+def last_session(session: Session, output: OutputFormat) -> EnvStepType:
+    if session.last_step is None:
+        raise HTTPException(404, detail="No environment information to return")
+    with session.lock:
+        return step_response(session, session.last_step, output)
+
+
+def seed_session(session: Session, seed: int) -> None:
+    with session.lock:
+        session.env.seed(seed)
+    return None
+
+
+def info_session(session: Session) -> Dict[str, Any]:
+    obs_space = session.env.observation_space
+    action_space = session.env.action_space
+    return {
+        "observation_space": extract_space_info(obs_space),
+        "action_space": extract_space_info(action_space)
+    }
 
 
 @app.post('/env/reset', response_model=ObservationType)
-def reset_env(seed: Optional[int] = None) -> ObservationType:
+def reset_env(seed: Optional[int] = None, output: OutputFormat = Depends()) -> ObservationType:
     "Reset the environment to initial position."
-    global env
-    env = check_env(env)
-    if seed:
-        env.seed(seed)
-    observation = env.reset()
-    obs = to_list(observation)
-    return obs
+    return reset_session(get_session(DEFAULT_ENV_ID), seed, output)
 
 
 @app.post("/env/step", response_model=Optional[EnvStepType])
-def post_step(env_action: EnvActionType):
+def post_step(env_action: EnvActionType = Depends(read_env_action), output: OutputFormat = Depends()):
     "Provides information necessary to step the environment."
-    global env, last_step, last_actions
-    env = check_env(env)
-    last_actions = env_action.actions
+    return step_session(get_session(DEFAULT_ENV_ID), env_action, output)
 
-    if env_action.commit:
-        last_step = commit(env, last_actions)
-        return last_step
-
-    return None
 
 @app.post('/env/commit', response_model=EnvStepType)
-def post_commit() -> EnvStepType:
+def post_commit(output: OutputFormat = Depends()) -> EnvStepType:
     "Commit last sent step data."
-    global env, last_actions, last_step
-    if last_actions is None:
-        raise HTTPException(400, "Cannot commit action without passing action. Please use `/env/step` first.")
-    env = check_env(env)
-    last_step = commit(env, last_actions)
-    # Clear action after commiting
-    last_actions = None
-    return last_step
+    return commit_session(get_session(DEFAULT_ENV_ID), output)
 
 
 @app.get('/env/last', response_model=EnvStepType)
-def get_last() -> EnvStepType:
+def get_last(output: OutputFormat = Depends()) -> EnvStepType:
     "Retrieve last provided Step data."
-    if last_step is None:
-        raise HTTPException(404, detail="No environment information to return")
-    return last_step
+    return last_session(get_session(DEFAULT_ENV_ID), output)
 
 @app.post('/env/seed')
 def set_seed(seed: int) -> None:
     "Set seed for environment's random number generator."
-    global env
-    env = check_env(env)
-    env.seed(seed)
-    return None
+    return seed_session(get_session(DEFAULT_ENV_ID), seed)
 
 
 @app.get('/env/info')
 def get_env_info() -> Dict[str, Any]:
-    assert env
-    obs_space = env.observation_space
-    action_space = env.action_space
-    return {
-        "observation_space": extract_space_info(obs_space),
-        "action_space": extract_space_info(action_space)
-    }
+    return info_session(get_session(DEFAULT_ENV_ID))
+
+
+@app.post('/env/{env_id}/reset', response_model=ObservationType)
+def reset_session_env(env_id: str, seed: Optional[int] = None, output: OutputFormat = Depends()) -> ObservationType:
+    "Reset the environment `env_id` to initial position."
+    return reset_session(get_session(env_id), seed, output)
+
+
+@app.post("/env/{env_id}/step", response_model=Optional[EnvStepType])
+def post_session_step(env_id: str, env_action: EnvActionType = Depends(read_env_action), output: OutputFormat = Depends()):
+    "Provides information necessary to step the environment `env_id`."
+    return step_session(get_session(env_id), env_action, output)
+
+
+@app.post('/env/{env_id}/commit', response_model=EnvStepType)
+def post_session_commit(env_id: str, output: OutputFormat = Depends()) -> EnvStepType:
+    "Commit last sent step data of the environment `env_id`."
+    return commit_session(get_session(env_id), output)
+
+
+@app.get('/env/{env_id}/last', response_model=EnvStepType)
+def get_session_last(env_id: str, output: OutputFormat = Depends()) -> EnvStepType:
+    "Retrieve last provided Step data of the environment `env_id`."
+    return last_session(get_session(env_id), output)
+
+
+@app.post('/env/{env_id}/seed')
+def set_session_seed(env_id: str, seed: int) -> None:
+    "Set seed for the random number generator of the environment `env_id`."
+    return seed_session(get_session(env_id), seed)
 
 
-def check_env(env: Optional[Environment]) -> Environment:
-    """Make sure env (environment) is defined correctly.
+@app.get('/env/{env_id}/info')
+def get_session_env_info(env_id: str) -> Dict[str, Any]:
+    return info_session(get_session(env_id))
+
+
+@app.websocket('/env/ws')
+async def stream_env(websocket: WebSocket, format: str = "npz", obs_format: str = "uint8", compress: bool = False, delta: bool = False):
+    "Stream steps of the default environment, see `/env/{env_id}/ws`."
+    await stream(websocket, DEFAULT_ENV_ID, format, obs_format, compress, delta)
+
+
+@app.websocket('/env/{env_id}/ws')
+async def stream_session_env(websocket: WebSocket, env_id: str, format: str = "npz", obs_format: str = "uint8", compress: bool = False, delta: bool = False):
+    """Stream steps of the environment `env_id` over one connection.
+
+    Every binary frame sent by the client (`format` is `npz` or `msgpack`) holds either an
+    `actions` array, which commits a step, or a `reset` entry (and optionally `seed`).
+    The server answers each frame, in order, with a frame in the same format holding the
+    step or the observation. Frames can be pipelined, i.e. the next actions can be sent
+    before the previous result was read. Errors are reported as JSON text frames.
+    With `compress=true` msgpack frames are deflate-compressed in both directions, npz frames
+    are compressed archives either way.
+
+    With `delta=true` observations are sent as deltas like for `/env/{env_id}/step`, client
+    frames then carry the `ack` and optionally `keyframe` entries.
+    """
+    await stream(websocket, env_id, format, obs_format, compress, delta)
+
+
+async def stream(websocket: WebSocket, env_id: str, format: str, obs_format: str, compress: bool, delta: bool = False) -> None:
+    media_types = {"npz": NPZ, "msgpack": MSGPACK}
+    try:
+        session = get_session(env_id)
+        if format not in media_types:
+            raise HTTPException(400, f"format must be one of {list(media_types)}")
+        output = OutputFormat(accept=media_types[format], obs_format=obs_format, compress=compress, delta=delta)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=str(e.detail))
+        return
+    await websocket.accept()
+
+    # frames are read ahead so clients can pipeline, and answered strictly in order
+    frames: asyncio.Queue = asyncio.Queue()
+
+    async def receive():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    await frames.put(None)
+                    return
+                await frames.put(message.get("bytes") or (message.get("text") or "").encode())
+        except Exception as e:
+            logging.exception("Receiving from the stream of '%s' failed", env_id)
+            await frames.put(e)
+
+    receiver = asyncio.ensure_future(receive())
+    try:
+        while True:
+            frame = await frames.get()
+            if frame is None:
+                break
+            if isinstance(frame, Exception):
+                await websocket.close(code=1011, reason=str(frame))
+                break
+            try:
+                reply = await run_in_threadpool(stream_frame, session, frame, output)
+            except (HTTPException, ValueError, KeyError, OSError) as e:
+                await websocket.send_text(json.dumps({"error": str(getattr(e, "detail", e))}))
+                continue
+            await websocket.send_bytes(reply)
+    finally:
+        receiver.cancel()
+
+
+def stream_frame(session: Session, frame: bytes, output: OutputFormat) -> bytes:
+    "Applies one streamed frame to the environment and encodes the reply."
+    # msgpack has no compression of its own, compressed streams deflate the frames of both sides
+    content_encoding = "deflate" if output.compress and output.media_type == MSGPACK else None
+    arrays = decode_arrays(frame, output.media_type, content_encoding)
+    ack = int(arrays["ack"]) if "ack" in arrays else None
+    keyframe = bool(arrays["keyframe"]) if "keyframe" in arrays else False
+    session.touch()
+    with session.lock:
+        if "reset" in arrays:
+            if "seed" in arrays:
+                session.env.seed(int(arrays["seed"]))
+            reply = observation_arrays(session, session.env.reset(), output, keyframe=True)
+        else:
+            session.last_step = commit(session.env, actions_from_array(arrays["actions"]))
+            reply = step_arrays(session, session.last_step, output, ack, keyframe)
+    return encode_arrays(reply, output.media_type, output.compress)[0]
+
+
+def get_session(env_id: str) -> Session:
+    """Look up the session of an environment.
     Intended to use directly and shortly after receiving API call.
     Raises:
-        HTTPException if there is anything wrong with provided environment.
+        HTTPException if the environment does not exist.
     """
-    if env is None:
-        detail ="Environment is not instantiated. Use POST /env to initiate."
-        raise HTTPException(400, detail=detail)
-    return env
+    try:
+        return registry.get(env_id)
+    except KeyError:
+        if env_id == DEFAULT_ENV_ID:
+            detail ="Environment is not instantiated. Use POST /env to initiate."
+            raise HTTPException(400, detail=detail)
+        raise HTTPException(404, detail=f"Environment '{env_id}' does not exist")
 
 
-def commit(env: Environment, actions: ActionType) -> EnvStepType:
+def commit(env: Environment, actions: ActionType) -> StepType:
     """Logic part that commits data to environment engine.
+    Returns the raw `(observation, reward, done, info)` tuple of `env.step`.
     Raises:
         HTTPException if there is anything wrong with provided data either before
         or after passing to the environment.
     """
     try:
-        out = env.step([actions])
+        out = env.step(actions[None] if isinstance(actions, np.ndarray) else [actions])
     except Exception as e:
         logging.exception("Something wrong while commiting step")
         raise HTTPException(500, str(e))
-    obs = to_list(out[0])
-    reward = to_list(out[1])
-    done = to_list(out[2])
-    info = {"info": str(out[3])}
-    step = EnvStepType(observation=obs, reward=reward, done=done, info=info)
-    return step
+    # observation buffers of the env are reused, keep a copy for `/env/last`
+    return (np.copy(out[0]),) + tuple(out[1:])
+
+
+def step_response(session: Session, step: StepType, output: OutputFormat) -> Union[EnvStepType, Response]:
+    "Encodes a step returned by `commit` in the negotiated format."
+    if output.media_type == JSON:
+        obs = to_list(step[0])
+        reward = to_list(step[1])
+        done = to_list(step[2])
+        info = {"info": str(step[3])}
+        return EnvStepType(observation=obs, reward=reward, done=done, info=info)
+    return binary_response(step_arrays(session, step, output, output.ack, output.keyframe), output)
+
+
+def step_arrays(session: Session, step: StepType, output: OutputFormat, ack: Optional[int] = None, keyframe: bool = False) -> Dict[str, np.ndarray]:
+    arrays = observation_arrays(session, step[0], output, ack, keyframe)
+    arrays.update(
+        reward=np.asarray(step[1], dtype=np.float32),
+        done=np.asarray(step[2], dtype=np.bool_),
+        raw_rewards=np.array([info["raw_rewards"] for info in step[3]], dtype=np.float32),
+    )
+    return arrays
+
+
+def observation_arrays(
+    session: Session, observation: np.ndarray, output: OutputFormat, ack: Optional[int] = None, keyframe: bool = False,
+) -> Dict[str, np.ndarray]:
+    "Encodes an observation, as a delta against the frame `ack` if the client asked for deltas."
+    arrays = encode_observation(observation, output.obs_format)
+    if not output.delta:
+        return arrays
+    encoder = session.delta_encoders.get(output.obs_format)
+    if encoder is None:
+        encoder = session.delta_encoders[output.obs_format] = DeltaEncoder(KEYFRAME_INTERVAL)
+    arrays.update(encoder.encode(arrays.pop("observation"), ack, keyframe))
+    return arrays
+
+
+def binary_response(arrays: Dict[str, np.ndarray], output: OutputFormat) -> Response:
+    try:
+        content, headers = encode_arrays(arrays, output.media_type, output.compress)
+    except ValueError as e:
+        raise HTTPException(406, str(e))
+    return Response(content=content, media_type=output.media_type, headers=headers)
@@ -0,0 +1,237 @@
+"""Throughput benchmark of the environment stack.
+
+Sweeps the number of selfplay and bot envs, maps, `partial_obs` and opponent AIs, and
+reports the steps per second together with the mean latency of every phase of a step, as
+recorded by the env's phase timers (see `MicroRTSGridModeVecEnv.get_stats`): `gameStep`, the
+Java to numpy conversion (`transfer`), `_encode_obs` (`encode`) and the reward weighting and
+info construction (`infos`). With `--stub` the JVM is replaced by `StubVecClient`, which
+measures the Python side only and runs without the Java build, e.g.
+
+    python -m gym_microrts.benchmark --stub --num-bot-envs 16 64 --output results.json
+    python -m gym_microrts.benchmark --stub --num-bot-envs 16 64 --baseline results.json
+
+Comparing against a baseline exits with status 1 if the SPS of any configuration dropped by
+more than `--tolerance`.
+"""
+import argparse
+import itertools
+import json
+import re
+import sys
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from gym_microrts import microrts_ai
+from gym_microrts.envs.grid_mode_vec_env import MicroRTSGridModeVecEnv
+
+PHASES = ("gameStep", "transfer", "encode", "infos")
+# unit types of the default unit type table, which sets the number of observation planes
+STUB_UNIT_TYPES = ["Resource", "Base", "Barracks", "Worker", "Light", "Heavy", "Ranged"]
+
+
+class StubVecClient:
+    """Stands in for `JNIGridnetVecClient`, answering with random numpy observations.
+
+    A few responses are generated up front and cycled through so the stub itself costs
+    next to nothing, the arrays have the shapes and dtypes the JVM returns.
+    """
+
+    def __init__(self, num_envs: int, num_planes: List[int], height: int, width: int, num_mask_values: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        high = np.array(num_planes)[:, None, None]
+        self._responses = [SimpleNamespace(
+            observation=(rng.random((num_envs, len(num_planes), height, width)) * high).astype(np.int32),
+            reward=rng.random((num_envs, 6)),
+            done=rng.random((num_envs, 2)) < 0.001,
+        ) for _ in range(4)]
+        self._masks = (rng.random((num_envs, height, width, num_mask_values)) < 0.5).astype(np.int32)
+        self._step = 0
+        self.selfPlayClients = []
+        self.clients = []
+
+    def reset(self, players):
+        self._step = 0
+        return self._responses[0]
+
+    def gameStep(self, actions, players):
+        self._step += 1
+        return self._responses[self._step % len(self._responses)]
+
+    def getMasks(self, player):
+        return self._masks
+
+    def close(self):
+        pass
+
+
+class StubGridModeVecEnv(MicroRTSGridModeVecEnv):
+    """A `MicroRTSGridModeVecEnv` on a `StubVecClient`, no JVM is started.
+
+    Map sizes are taken from the map path, e.g. `maps/16x16/...`, so no map files are needed.
+    """
+
+    def launch(self) -> None:
+        self.startup_times = {}
+        self.real_utt = None
+        self.rfs = None
+
+    def start_client(self) -> None:
+        self.utt = {"unitTypes": [{"name": name} for name in STUB_UNIT_TYPES]}
+        num_planes = [5, 5, 3, len(STUB_UNIT_TYPES) + 1, 6] + ([2] if self.partial_obs else [])
+        self.vec_client = StubVecClient(self.num_envs, num_planes, self.height, self.width, 1 + 6 + 4 * 4 + len(STUB_UNIT_TYPES) + 7 * 7)
+        self.render_client = None
+
+    def _map_size(self, map_path):
+        height, width = re.search(r"(\d+)x(\d+)", map_path).groups()
+        return int(height), int(width)
+
+    def close(self, shutdown_jvm=False):
+        self._executor.shutdown(wait=True)
+
+
+def run_benchmark(
+    num_selfplay_envs: int = 0,
+    num_bot_envs: int = 16,
+    map_path: str = "maps/16x16/basesWorkers16x16.xml",
+    partial_obs: bool = False,
+    ai: str = "coacAI",
+    num_steps: int = 200,
+    warmup_steps: int = 10,
+    stub: bool = False,
+    extra_ais: Sequence[str] = (),
+) -> Dict:
+    """Steps one configuration with empty actions and returns its SPS and phase latencies in ms.
+
+    SPS counts env steps, i.e. `num_steps * num_envs` over the wall time of the steps.
+    `extra_ais` are loaded into the JVM too, for later configurations of the same process.
+    """
+    env_cls = StubGridModeVecEnv if stub else MicroRTSGridModeVecEnv
+    env = env_cls(
+        num_selfplay_envs=num_selfplay_envs,
+        num_bot_envs=num_bot_envs,
+        partial_obs=partial_obs,
+        ai2s=[getattr(microrts_ai, ai) for _ in range(num_bot_envs)],
+        map_path=map_path,
+        instrument=True,
+        extra_ais=[getattr(microrts_ai, name) for name in extra_ais],
+    )
+    try:
+        env.reset()
+        actions = [[] for _ in range(env.num_envs)]
+        for _ in range(warmup_steps):
+            env.step(actions)
+        env.stats.clear()
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            env.step(actions)
+        elapsed = time.perf_counter() - start
+    finally:
+        env.close(shutdown_jvm=False)
+
+    stats = env.get_stats()
+    return {
+        "config": {
+            "num_selfplay_envs": num_selfplay_envs,
+            "num_bot_envs": num_bot_envs,
+            "map_path": map_path,
+            "partial_obs": partial_obs,
+            "ai": ai,
+            "stub": stub,
+        },
+        "sps": num_steps * env.num_envs / elapsed,
+        # phases that did not run, e.g. without instrumentation, are reported as NaN
+        "phase_ms": {phase: stats.get(phase, {}).get("mean", float("nan")) * 1e3 for phase in PHASES},
+        "startup_times": env.startup_times,
+    }
+
+
+def sweep(
+    num_selfplay_envs: List[int],
+    num_bot_envs: List[int],
+    map_paths: List[str],
+    partial_obs: List[bool],
+    ais: List[str],
+    **kwargs,
+) -> List[Dict]:
+    """Runs `run_benchmark` for every combination of the given values.
+
+    Without bot envs the opponent AI does not matter, so those configurations run only once.
+    All configurations share the JVM of this process, which is launched with the jars of all `ais`.
+    """
+    kwargs.setdefault("extra_ais", ais)
+    results = []
+    for selfplay, bots, map_path, po, ai in itertools.product(num_selfplay_envs, num_bot_envs, map_paths, partial_obs, ais):
+        if selfplay + bots == 0 or (bots == 0 and ai != ais[0]):
+            continue
+        result = run_benchmark(selfplay, bots, map_path, po, ai, **kwargs)
+        print(format_result(result), flush=True)
+        results.append(result)
+    return results
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float = 0.1) -> List[str]:
+    """Returns a message for every configuration whose SPS is more than `tolerance` below the baseline.
+
+    Configurations missing from the baseline are not compared.
+    """
+    baseline_sps = {_config_key(result["config"]): result["sps"] for result in baseline}
+    regressions = []
+    for result in results:
+        key = _config_key(result["config"])
+        if key in baseline_sps and result["sps"] < baseline_sps[key] * (1 - tolerance):
+            regressions.append(
+                f"{_format_config(result['config'])}: {result['sps']:.0f} SPS, "
+                f"baseline {baseline_sps[key]:.0f} SPS ({result['sps'] / baseline_sps[key] - 1:+.1%})")
+    return regressions
+
+
+def format_result(result: Dict) -> str:
+    phases = " ".join(f"{phase}={ms:.3f}ms" for phase, ms in result["phase_ms"].items())
+    return f"{_format_config(result['config'])}: {result['sps']:10.0f} SPS  {phases}"
+
+
+def _config_key(config: Dict) -> str:
+    return json.dumps(config, sort_keys=True)
+
+
+def _format_config(config: Dict) -> str:
+    return (f"selfplay={config['num_selfplay_envs']} bots={config['num_bot_envs']} map={config['map_path']} "
+            f"partial_obs={config['partial_obs']} ai={config['ai']}{' stub' if config['stub'] else ''}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-selfplay-envs", type=int, nargs="+", default=[0])
+    parser.add_argument("--num-bot-envs", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--map-paths", nargs="+", default=["maps/10x10/basesTwoWorkers10x10.xml", "maps/16x16/basesWorkers16x16.xml"])
+    parser.add_argument("--partial-obs", type=lambda x: x.lower() in ("1", "true", "yes"), nargs="+", default=[False])
+    parser.add_argument("--ais", nargs="+", default=["coacAI"], help="names of the opponent AIs in `microrts_ai`")
+    parser.add_argument("--num-steps", type=int, default=200)
+    parser.add_argument("--warmup-steps", type=int, default=10)
+    parser.add_argument("--stub", action="store_true", help="replace the JVM by a stub vec client")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative SPS drop against the baseline")
+    args = parser.parse_args(argv)
+
+    results = sweep(
+        args.num_selfplay_envs, args.num_bot_envs, args.map_paths, args.partial_obs, args.ais,
+        num_steps=args.num_steps, warmup_steps=args.warmup_steps, stub=args.stub,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
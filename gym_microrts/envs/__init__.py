@@ -1,2 +1,4 @@
 from .grid_mode_vec_env import MicroRTSGridModeVecEnv
 from .bot_vec_env import MicroRTSBotVecEnv
+from .sharded_vec_env import MicroRTSShardedVecEnv
+from .alternating_vec_env import MicroRTSAlternatingVecEnv
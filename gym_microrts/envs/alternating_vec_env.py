@@ -0,0 +1,107 @@
+import numpy as np
+
+from .grid_mode_vec_env import MicroRTSGridModeVecEnv, grid_size
+
+
+class MicroRTSAlternatingVecEnv:
+    """Splits the envs into two halves that are stepped alternately.
+
+    Both halves are MicroRTSGridModeVecEnv instances sharing the JVM of this process.
+    `step(actions)` takes the actions for the half whose observations were returned last,
+    dispatches that half to the JVM and returns the results of the other half, so policy
+    inference on one half overlaps with the simulation of the other::
+
+        obs = env.reset()                # half 0
+        obs, reward, done, infos = env.step(policy(obs))  # half 1
+        obs, reward, done, infos = env.step(policy(obs))  # half 0
+        ...
+
+    `active_half` tells which half the last returned batch belongs to.
+    """
+
+    def __init__(self,
+        num_selfplay_envs,
+        num_bot_envs,
+        ai2s=[],
+        **env_kwargs):
+        assert num_selfplay_envs % 2 == 0, "selfplay envs are played in pairs"
+        assert num_bot_envs == len(ai2s), "for each environment, a microrts ai should be provided"
+        self.num_selfplay_envs = num_selfplay_envs
+        self.num_bot_envs = num_bot_envs
+        self.num_envs = num_selfplay_envs + num_bot_envs
+
+        num_pairs = num_selfplay_envs // 2
+        selfplay_splits = [2 * (num_pairs - num_pairs // 2), 2 * (num_pairs // 2)]
+        bot_splits = [num_bot_envs - num_bot_envs // 2, num_bot_envs // 2]
+        assert min(s + b for s, b in zip(selfplay_splits, bot_splits)) > 0, "each half needs at least one env"
+        # half 0 launches the JVM, it needs the jars of the AIs of both halves
+        env_kwargs["extra_ais"] = list(ai2s) + list(env_kwargs.get("extra_ais", []))
+        map_paths = env_kwargs.pop("map_paths", None)
+        half_map_paths = [None, None]
+        if map_paths is not None:
+            # both halves pad their envs to the grid of the largest map of all envs
+            env_kwargs["grid_size"] = grid_size(map_paths)
+            selfplay_maps, bot_maps = list(map_paths[:num_selfplay_envs]), list(map_paths[num_selfplay_envs:])
+            half_map_paths = [
+                selfplay_maps[:selfplay_splits[0]] + bot_maps[:bot_splits[0]],
+                selfplay_maps[selfplay_splits[0]:] + bot_maps[bot_splits[0]:],
+            ]
+        self.halves = [
+            MicroRTSGridModeVecEnv(
+                num_selfplay_envs=selfplay_splits[0],
+                num_bot_envs=bot_splits[0],
+                ai2s=ai2s[:bot_splits[0]],
+                map_paths=half_map_paths[0],
+                **env_kwargs),
+            MicroRTSGridModeVecEnv(
+                num_selfplay_envs=selfplay_splits[1],
+                num_bot_envs=bot_splits[1],
+                ai2s=ai2s[bot_splits[0]:],
+                map_paths=half_map_paths[1],
+                **env_kwargs),
+        ]
+        self.observation_space = self.halves[0].observation_space
+        self.action_space = self.halves[0].action_space
+        self.active_half = 0
+        self._pending = None
+
+    def reset(self):
+        """Resets both halves and returns the observations of half 0."""
+        obs = [half.reset() for half in self.halves]
+        # the first step returns the reset observations of half 1
+        num_envs = self.halves[1].num_envs
+        self._pending = (
+            obs[1],
+            np.zeros(num_envs),
+            np.zeros(num_envs, dtype=np.bool_),
+            [{"raw_rewards": np.zeros(len(self.halves[1].rfs))} for _ in range(num_envs)],
+        )
+        self.active_half = 0
+        return obs[0]
+
+    def step(self, ac):
+        """Dispatches `ac` for the active half and returns the results of the other half."""
+        self.halves[self.active_half].step_async(ac)
+        self.active_half = 1 - self.active_half
+        if self._pending is not None:
+            result, self._pending = self._pending, None
+            return result
+        return self.halves[self.active_half].step_wait()
+
+    def get_action_mask(self, packed=False):
+        """Returns the action masks of the active half."""
+        return self.halves[self.active_half].get_action_mask(packed)
+
+    def seed(self, seed) -> None:
+        for half in self.halves:
+            half.seed(seed)
+
+    def render(self, mode="human"):
+        return self.halves[0].render(mode)
+
+    def close(self):
+        for half in self.halves:
+            if half._step_future is not None:
+                half.step_wait()
+        self.halves[0].close(shutdown_jvm=False)
+        self.halves[1].close()
@@ -2,17 +2,19 @@
 import json
 import logging
 import os
-import xml.etree.ElementTree as ET
+import time
 
 import gym
 import gym_microrts
 import jpype
 import numpy as np
-from jpype.imports import registerDomain
-from jpype.types import JArray
+from gym_microrts.stats import PhaseTimer
+from gym_microrts.utils import java_to_numpy
+from jpype.types import JArray, JInt
 from PIL import Image
 
-from .grid_mode_vec_env import MicroRTSGridModeVecEnv
+from .grid_mode_vec_env import OBS_FORMATS, MicroRTSGridModeVecEnv
+from .jvm import launch_jvm
 
 
 class MicroRTSBotVecEnv(MicroRTSGridModeVecEnv):
@@ -20,6 +22,15 @@ class MicroRTSBotVecEnv(MicroRTSGridModeVecEnv):
         'render.modes': ['human', 'rgb_array'],
         'video.frames_per_second' : 150
     }
+    """
+    Plays `ai1s[i]` against `ai2s[i]` in env i, the actions passed to `step` are ignored.
+
+    With `expert=True` the env serves demonstrations of the `ai1s` bots: `reset` and `step`
+    return the encoded observations of player 0 in `obs_format` like the grid env,
+    `get_action_mask` the masks of player 0 and `get_expert_actions` the actions the `ai1s`
+    bots issued in the last step in the dense gridnet layout. Otherwise observations are
+    placeholders.
+    """
 
     def __init__(self,
         ai1s=[],
@@ -27,69 +38,61 @@ class MicroRTSBotVecEnv(MicroRTSGridModeVecEnv):
         partial_obs=False,
         max_steps=2000,
         map_path="maps/10x10/basesTwoWorkers10x10.xml",
-        reward_weight=np.array([0.0, 1.0, 0.0, 0.0, 0.0, 5.0])):
+        reward_weight=np.array([0.0, 1.0, 0.0, 0.0, 0.0, 5.0]),
+        instrument=False,
+        expert=False,
+        obs_format="onehot",
+        extra_ais=()):
         self.logger = logging.getLogger("")
+        self.stats = PhaseTimer(enabled=instrument)
 
-        self.ai1s = ai1s
-        self.ai2s = ai2s
+        self.ai1s = list(ai1s)
+        self.ai2s = list(ai2s)
+        # AIs this process will use later on, e.g. for `set_matchups`, their jars are loaded at launch
+        self.extra_ais = list(extra_ais)
         assert len(ai1s) == len(ai2s), "for each environment, a microrts ai should be provided"
         self.num_envs = len(ai1s)
         self.partial_obs = partial_obs
         self.max_steps = max_steps
         self.map_path = map_path
+        self.map_paths = [map_path] * self.num_envs
         self.reward_weight = reward_weight
+        self.expert = expert
+        assert not (expert and partial_obs), "expert observations are only available for full observability"
+        if obs_format not in OBS_FORMATS:
+            raise ValueError(f"Unknown observation format '{obs_format}', expected one of {OBS_FORMATS}")
+        self.obs_format = obs_format
+        self._init_state()
 
         # read map
         self.microrts_path = os.path.join(gym_microrts.__path__[0], 'microrts')
-        root = ET.parse(os.path.join(self.microrts_path, self.map_path)).getroot()
-        self.height, self.width = int(root.get("height")), int(root.get("width"))
-
-        # launch the JVM
-        if not jpype._jpype.isStarted():
-            registerDomain("ts", alias="tests")
-            registerDomain("ai")
-            jars = [
-                "microrts.jar", "Coac.jar", "Droplet.jar", "GRojoA3N.jar",
-                "Izanagi.jar", "MixedBot.jar", "RojoBot.jar", "TiamatBot.jar", "UMSBot.jar" # "MindSeal.jar"
-            ]
-            for jar in jars:
-                jpype.addClassPath(os.path.join(self.microrts_path, jar))
-            jpype.startJVM(convertStrings=False)
-
-        # start microrts client
-        from rts.units import UnitTypeTable
-        self.real_utt = UnitTypeTable()
-        from ai.rewardfunction import (AttackRewardFunction,
-                                       CloserToEnemyBaseRewardFunction,
-                                       ProduceBuildingRewardFunction,
-                                       ProduceCombatUnitRewardFunction,
-                                       ProduceWorkerRewardFunction,
-                                       ResourceGatherRewardFunction,
-                                       RewardFunctionInterface,
-                                       WinLossRewardFunction)
-        self.rfs = JArray(RewardFunctionInterface)([
-            WinLossRewardFunction(), 
-            ResourceGatherRewardFunction(),  
-            ProduceWorkerRewardFunction(),
-            ProduceBuildingRewardFunction(),
-            AttackRewardFunction(),
-            ProduceCombatUnitRewardFunction(),
-            # CloserToEnemyBaseRewardFunction(),
-        ])
+        self.height, self.width = self._map_size(self.map_path)
+
+        self.launch(self.ai1s + self.ai2s + self.extra_ais)
         self.start_client()
+        self.logger.info("Startup phases (s): %s", self.startup_times)
+
+        self._init_spaces()
+        if expert:
+            self._init_expert()
+        else:
+            # without demonstrations observations and actions are placeholders
+            self.observation_space = gym.spaces.Discrete(2)
+            self.action_space = gym.spaces.Discrete(2)
 
-        self.num_planes = [5, 5, 3, len(self.utt['unitTypes'])+1, 6]
-        if partial_obs:
-            self.num_planes = [5, 5, 3, len(self.utt['unitTypes'])+1, 6, 2]
-        self.observation_space = gym.spaces.Discrete(2)
-        self.action_space = gym.spaces.Discrete(2)
+    def _init_expert(self):
+        """Sets up the state of the grid env needed to encode the demonstrations."""
+        self._padded = False
+        self.valid_cells = np.ones((self.num_envs, self.height, self.width), dtype=np.bool_)
+        self._expert_actions = np.zeros((self.num_envs, self.height * self.width, 7), dtype=np.int32)
+        self._mask_size = 1 + int(sum(self.action_space.nvec[1:]))
 
     def start_client(self) -> None:
         """Start Client to communicate with microRTS environment.
         
         Client is accessable as `vec_client` property on the instance.
         """
-
+        start = time.perf_counter()
         from ai.core import AI
         from ts import JNIGridnetVecClient as Client
         self.vec_client = Client(
@@ -103,8 +106,52 @@ class MicroRTSBotVecEnv(MicroRTSGridModeVecEnv):
             self.partial_obs,
         )
         self.render_client = self.vec_client.botClients[0]
+        self.startup_times["client_construction"] = time.perf_counter() - start
         # get the unit type table
+        start = time.perf_counter()
         self.utt = json.loads(str(self.render_client.sendUTT()))
+        self.startup_times["utt_fetch"] = time.perf_counter() - start
+
+    def _env_client(self, env_idx):
+        return self.vec_client.botClients[env_idx], 0
+
+    def set_matchups(self, env_indices, ai1_factories, ai2_factories, map_paths=None):
+        """Restarts env `env_indices[i]` as a game of `ai1_factories[i]` against `ai2_factories[i]`.
+
+        Unlike `set_opponents` of the grid env the swap is immediate, the other envs keep
+        playing. `map_paths` optionally moves the games to other maps of the same size as the
+        map of this env. AI instances are cached per env, player and factory and reset
+        before every game.
+        """
+        assert len(env_indices) == len(ai1_factories) == len(ai2_factories), "for each environment, two microrts ais should be provided"
+        # fails early if the JVM was started without the jars of these AIs
+        launch_jvm(self.microrts_path, list(ai1_factories) + list(ai2_factories))
+        map_paths = map_paths or [self.map_paths[env_idx] for env_idx in env_indices]
+        for env_idx, ai1, ai2, map_path in zip(env_indices, ai1_factories, ai2_factories, map_paths):
+            client, player = self._env_client(env_idx)
+            if map_path != self.map_paths[env_idx]:
+                if self._map_size(map_path) != (self.height, self.width):
+                    raise ValueError(f"{map_path} is not {self.height}x{self.width} like the maps of this env")
+                client.mapPath = os.path.join(self.microrts_path, map_path)
+                self.map_paths[env_idx] = map_path
+            client.ai1 = self._ai_instance(env_idx, 1, ai1)
+            client.ai2 = self._ai_instance(env_idx, 2, ai2)
+            client.reset(player)
+            self.ai1s[env_idx], self.ai2s[env_idx] = ai1, ai2
+
+    def set_opponents(self, env_indices, ai_factories):
+        raise NotImplementedError("use set_matchups to change the AIs of a bot env")
+
+    def set_maps(self, per_env_paths):
+        raise NotImplementedError("use set_matchups to change the maps of a bot env")
+
+    def _ai_instance(self, env_idx, player, ai_factory):
+        key = (env_idx, player, ai_factory)
+        if key not in self._opponent_cache:
+            self._opponent_cache[key] = ai_factory(self.real_utt)
+        ai = self._opponent_cache[key]
+        ai.reset()
+        return ai
 
     def seed(self, seed: int) -> None:
         """Sets seed for action space"""
@@ -112,24 +159,120 @@ class MicroRTSBotVecEnv(MicroRTSGridModeVecEnv):
         self.logger.warning("")
 
     def reset(self):
-        responses = self.vec_client.reset([0]*self.num_envs)
+        with self.stats.time("reset"):
+            responses = self.vec_client.reset([0]*self.num_envs)
+        if self.expert:
+            self._expert_actions.fill(0)
+            return self._observe()
         raw_obs = np.ones((self.num_envs,2)),
-        reward = np.array(responses.reward)
-        done = np.array(responses.done)
         info = {}
         return raw_obs
 
+    def reset_envs(self, env_indices):
+        """Restarts only the games of `env_indices`, the other envs keep playing."""
+        for env_idx in env_indices:
+            client, player = self._env_client(env_idx)
+            client.reset(player)
+        if self.expert:
+            self._expert_actions[env_indices] = 0
+            return self._observe()[env_indices]
+        return np.ones((len(env_indices), 2))
+
+    def snapshot(self, env_indices):
+        raise NotImplementedError("snapshots do not hold the state of the ai1s bots")
+
+    def restore(self, handles, env_indices=None):
+        raise NotImplementedError("snapshots do not hold the state of the ai1s bots")
+
+    def _observe(self):
+        """Encodes the observations of player 0 and caches its action masks.
+
+        The bot clients have no batched mask call, so the masks are built with one
+        `getValidActionArray` call through JPype per idle unit of player 0, which makes
+        expert steps noticeably slower than plain bot steps on crowded maps.
+        """
+        from rts import UnitAction
+        clients = self.vec_client.botClients
+        with self.stats.time("transfer"):
+            raw_obs = np.stack([java_to_numpy(client.gs.getVectorObservation(0), shape=(-1, self.height, self.width)) for client in clients])
+        with self.stats.time("masks"):
+            masks = np.zeros((self.num_envs, self.height, self.width, self._mask_size), dtype=np.bool_)
+            for env_idx, client in enumerate(clients):
+                gs = client.gs
+                for unit in gs.getPhysicalGameState().getUnits():
+                    if unit.getPlayer() != 0 or gs.getActionAssignment(unit) is not None:
+                        continue
+                    mask = JArray(JInt)(self._mask_size)
+                    mask[0] = 1
+                    UnitAction.getValidActionArray(unit, gs, self.real_utt, mask, 7, 1)
+                    masks[env_idx, unit.getY(), unit.getX()] = java_to_numpy(mask)
+            self._action_masks = {False: masks}
+        with self.stats.time("encode"):
+            return self._encode_obs(raw_obs)
+
+    def _issued_actions(self, times):
+        """Collects the actions `ai1s` issued at game time `times[i]` in the gridnet layout.
+
+        Actions are read from the unit action assignments of the game states. Games that
+        ended in the last step were already restarted, their last actions are lost and
+        stay zero.
+        """
+        actions = self._expert_actions
+        actions.fill(0)
+        for env_idx, client in enumerate(self.vec_client.botClients):
+            gs = client.gs
+            if gs.getTime() != times[env_idx] + 1:
+                continue
+            for entry in gs.getUnitActions().entrySet():
+                assignment = entry.getValue()
+                unit, action = assignment.unit, assignment.action
+                if assignment.time != times[env_idx] or unit.getPlayer() != 0:
+                    continue
+                row = actions[env_idx, unit.getY() * self.width + unit.getX()]
+                action_type = action.getType()
+                row[0] = action_type
+                if 1 <= action_type <= 4:
+                    # move, harvest, return and produce store their direction in component `action_type`
+                    row[action_type] = action.getDirection()
+                if action_type == 4:
+                    row[5] = action.getUnitType().ID
+                elif action_type == 5:
+                    row[6] = (action.getLocationY() - unit.getY() + 3) * 7 + (action.getLocationX() - unit.getX() + 3)
+        return actions
+
+    def get_action_mask(self, packed=False):
+        """Masks of player 0 for the last observation, only available with `expert=True`."""
+        if not self.expert:
+            raise RuntimeError("action masks are only available with expert=True")
+        return super().get_action_mask(packed)
+
+    def get_expert_actions(self):
+        """Returns the (num_envs, height * width, 7) actions the `ai1s` issued in the last
+        step for the observation before it, zero for cells without a newly issued action."""
+        return self._expert_actions
+
     def step_async(self, actions):
         self.actions = actions
 
     def step_wait(self):
         e = [0 for _ in range(self.num_envs)]
-        self.logger.info(self.actions)
-        self.logger.info(e)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("gameStep actions %s players %s", self.actions, e)
 
-        responses = self.vec_client.gameStep(self.actions, e)
-        raw_obs, reward, done = np.ones((self.num_envs,2)), np.array(responses.reward), np.array(responses.done)
-        infos = [{"raw_rewards": item} for item in reward]
+        if self.expert:
+            times = [client.gs.getTime() for client in self.vec_client.botClients]
+        with self.stats.time("gameStep"):
+            responses = self.vec_client.gameStep(self.actions, e)
+        with self.stats.time("transfer"):
+            raw_obs = np.ones((self.num_envs,2))
+            reward = java_to_numpy(responses.reward, shape=(self.num_envs, -1))
+            done = java_to_numpy(responses.done, shape=(self.num_envs, -1))
+        if self.expert:
+            with self.stats.time("actions"):
+                self._issued_actions(times)
+            raw_obs = self._observe()
+        with self.stats.time("infos"):
+            infos = [{"raw_rewards": item} for item in reward]
         return raw_obs, reward @ self.reward_weight, done[:,0], infos
 
     def step(self, ac):
@@ -149,14 +292,17 @@ class MicroRTSBotVecEnv(MicroRTSGridModeVecEnv):
             return None
 
     def render(self, mode="human"):
-        if mode == "human":
-            self.render_client.render(False)
-        elif mode == 'rgb_array':
-            bytes_array = np.array(self.render_client.render(True))
-            image = Image.frombytes("RGB", (640, 640), bytes_array)
-            return np.array(image)[:,:,::-1]
-
-    def close(self):
+        with self.stats.time("render"):
+            if mode == "human":
+                self.render_client.render(False)
+            elif mode == 'rgb_array':
+                bytes_array = np.array(self.render_client.render(True))
+                image = Image.frombytes("RGB", (640, 640), bytes_array)
+                return np.array(image)[:,:,::-1]
+
+    def close(self, shutdown_jvm=True):
+        self._executor.shutdown(wait=True)
         if jpype._jpype.isStarted():
             self.vec_client.close()
-            jpype.shutdownJVM()
+            if shutdown_jvm:
+                jpype.shutdownJVM()
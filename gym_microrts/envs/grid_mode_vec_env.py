@@ -1,22 +1,58 @@
 import json
 import logging
 import os
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import gym
 import gym_microrts
 import jpype
-import jpype.imports
 import numpy as np
-from gym_microrts.utils import to_numpy
-from jpype.imports import registerDomain
-from jpype.types import JArray
+from gym_microrts import rendering
+from gym_microrts.stats import PhaseTimer
+from gym_microrts.utils import (java_to_numpy, onehot_to_planes,
+                                planes_to_onehot, to_numpy)
+from jpype.types import JArray, JInt
 from PIL import Image
 
-JARS = [
-    "microrts.jar", "Coac.jar", "Droplet.jar", "GRojoA3N.jar",
-    "Izanagi.jar", "MixedBot.jar", "RojoBot.jar", "TiamatBot.jar", "UMSBot.jar" # "MindSeal.jar"
-]
+# JARS moved to `jvm`, re-exported for code importing it from here
+from .jvm import JARS, launch_jvm
+
+# `onehot` matches the observations of earlier versions, the others are compact alternatives
+OBS_FORMATS = ("onehot", "onehot_uint8", "planes", "packed")
+
+
+def read_map_size(map_path):
+    """Returns the height and width of a map, `map_path` is relative to the microrts directory."""
+    root = ET.parse(os.path.join(gym_microrts.__path__[0], 'microrts', map_path)).getroot()
+    return int(root.get("height")), int(root.get("width"))
+
+
+def grid_size(map_paths):
+    """Returns the height and width of the grid all of `map_paths` are padded to."""
+    sizes = [read_map_size(path) for path in set(map_paths)]
+    return max(h for h, _ in sizes), max(w for _, w in sizes)
+
+
+class GameSnapshot:
+    """Handle to a saved game, returned by `MicroRTSGridModeVecEnv.snapshot`.
+
+    Holds a Java clone of the `GameState` and, for bot envs, of the opponent AI. Restoring
+    clones them again, so a snapshot can be restored any number of times.
+    """
+
+    __slots__ = ("env_idx", "map_path", "game_state", "ai2")
+
+    def __init__(self, env_idx, map_path, game_state, ai2=None):
+        self.env_idx = env_idx
+        self.map_path = map_path
+        self.game_state = game_state
+        self.ai2 = ai2
+
+    @property
+    def time(self):
+        return self.game_state.getTime()
 
 class MicroRTSGridModeVecEnv:
     metadata = {
@@ -30,6 +66,19 @@ class MicroRTSGridModeVecEnv:
 
     Create a baselines VecEnv environment from a gym3 environment.
 
+    Observations are returned in `obs_format`:
+    `onehot` (h, w, sum(num_planes)) int32 one-hot feature planes,
+    `onehot_uint8` the same as uint8,
+    `planes` (h, w, len(num_planes)) uint8 index of every feature, to be one-hot encoded by the consumer,
+    `packed` the uint8 one-hot planes bit-packed along the last axis with `np.packbits`.
+
+    With `frame_skip=k` every step advances the games k + 1 ticks. The actions are issued on
+    the first tick and, with `repeat_actions=True`, again on the skipped ticks; otherwise the
+    skipped ticks issue no actions. Raw rewards are summed over the ticks and the step ends
+    early as soon as any env is done. The ticks are looped in Python, so a step still makes
+    k + 1 `gameStep` calls and reward/done transfers; only the observation encoding and
+    the policy calls are saved.
+
     :param env: gym3 environment to adapt
     """
 
@@ -41,8 +90,16 @@ class MicroRTSGridModeVecEnv:
         frame_skip=0,
         ai2s=[],
         map_path="maps/10x10/basesTwoWorkers10x10.xml",
-        reward_weight=np.array([0.0, 1.0, 0.0, 0.0, 0.0, 5.0])):
+        reward_weight=np.array([0.0, 1.0, 0.0, 0.0, 0.0, 5.0]),
+        map_paths=None,
+        instrument=False,
+        obs_format="onehot",
+        repeat_actions=False,
+        extra_ais=(),
+        grid_size=None):
         self.logger = logging.getLogger("MicroRTSGridEnv")
+        # phase timers, see `get_stats`
+        self.stats = PhaseTimer(enabled=instrument)
 
         self.num_selfplay_envs = num_selfplay_envs
         self.num_bot_envs = num_bot_envs
@@ -51,24 +108,98 @@ class MicroRTSGridModeVecEnv:
         self.partial_obs = partial_obs
         self.max_steps = max_steps
         self.frame_skip = frame_skip
-        self.ai2s = ai2s
+        self.repeat_actions = repeat_actions
+        self.ai2s = list(ai2s)
+        # AIs this process will use later on, e.g. for `set_opponents`, their jars are loaded at launch
+        self.extra_ais = list(extra_ais)
         self.map_path = map_path
+        self.map_paths = list(map_paths) if map_paths is not None else [map_path] * self.num_envs
+        assert len(self.map_paths) == self.num_envs, "for each environment, a map should be provided"
         self.reward_weight = to_numpy(reward_weight)
+        if obs_format not in OBS_FORMATS:
+            raise ValueError(f"Unknown observation format '{obs_format}', expected one of {OBS_FORMATS}")
+        self.obs_format = obs_format
+        self._init_state()
 
-        # read map
+        # read maps, envs on smaller maps are padded to the largest height and width
         self.microrts_path = os.path.join(gym_microrts.__path__[0], 'microrts')
-        root = ET.parse(os.path.join(self.microrts_path, self.map_path)).getroot()
-        self.height, self.width = int(root.get("height")), int(root.get("width"))
-
-        # launch the JVM
-        if not jpype._jpype.isStarted():
-            registerDomain("ts", alias="tests")
-            registerDomain("ai")
-            for jar in JARS:
-                jpype.addClassPath(os.path.join(self.microrts_path, jar))
-            jpype.startJVM(convertStrings=False)
-
-        # start microrts client
+        sizes = [self._map_size(path) for path in self.map_paths]
+        self.height, self.width = max(h for h, _ in sizes), max(w for _, w in sizes)
+        if grid_size is not None:
+            # wrappers splitting the envs pad all of them to one grid
+            assert grid_size[0] >= self.height and grid_size[1] >= self.width, f"the maps do not fit into a {grid_size} grid"
+            self.height, self.width = grid_size
+        if map_paths is not None:
+            # the client starts on the largest map, the others are swapped in by `set_maps`
+            self.map_path = max(self.map_paths, key=lambda path: np.prod(self._map_size(path)))
+
+        self.launch()
+        self.start_client()
+        self.logger.info("Startup phases (s): %s", self.startup_times)
+
+        self._init_spaces()
+        self._source_unit_idxs = np.arange(self.height * self.width, dtype=np.int32)[:, None]
+        if map_paths is not None:
+            # the clients load their own map on the first reset
+            for env_idx, path in enumerate(self.map_paths):
+                self._env_client(env_idx)[0].mapPath = os.path.join(self.microrts_path, path)
+        self._update_map_layout()
+
+    def _init_state(self):
+        """Sets up the caches, the pending opponent and map swaps and the step thread."""
+        self._map_sizes = {}
+        self._opponent_cache = {}
+        self._pending_opponents = {}
+        self._pending_maps = {}
+        self._action_masks = {}
+        # gameStep runs on a background thread, JPype releases the GIL during Java calls
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="MicroRTSGridEnv")
+        self._step_future = None
+
+    def _observation_space(self):
+        if self.obs_format == "planes":
+            high = np.broadcast_to(np.array(self.num_planes) - 1, (self.height, self.width, len(self.num_planes)))
+            return gym.spaces.Box(low=0, high=high, dtype=np.uint8)
+        if self.obs_format == "packed":
+            return gym.spaces.Box(low=0, high=255, shape=(self.height, self.width, -(-sum(self.num_planes) // 8)), dtype=np.uint8)
+        return gym.spaces.Box(low=0.0,
+            high=1.0,
+            shape=(self.height, self.width,
+                    sum(self.num_planes)),
+                    dtype=np.int32 if self.obs_format == "onehot" else np.uint8)
+
+    def _init_spaces(self):
+        """Sets up `num_planes`, the observation and action spaces and the encoding buffers."""
+        self.num_planes = [5, 5, 3, len(self.utt['unitTypes'])+1, 6]
+        if self.partial_obs:
+            self.num_planes = [5, 5, 3, len(self.utt['unitTypes'])+1, 6, 2]
+        self.observation_space = self._observation_space()
+        # plane offsets and the reusable encoding buffers are fixed for the lifetime of the env,
+        # two buffers alternate so the next step can be encoded while the caller holds the last one
+        self._plane_offsets = np.cumsum([0] + self.num_planes[:-1])[:, None]
+        self._plane_max = np.array(self.num_planes)[:, None] - 1
+        buffer_planes = len(self.num_planes) if self.obs_format == "planes" else sum(self.num_planes)
+        buffer_dtype = np.int32 if self.obs_format == "onehot" else np.uint8
+        self._obs_buffers = [np.zeros(
+            (self.num_envs, self.height * self.width, buffer_planes), dtype=buffer_dtype) for _ in range(2)]
+        self._obs_buffer_idx = 0
+        self.action_space = gym.spaces.MultiDiscrete([
+            self.height * self.width,
+            6, 4, 4, 4, 4,
+            len(self.utt['unitTypes']),
+            7 * 7
+        ])
+
+    def launch(self, ais=None) -> None:
+        """Launches the JVM with the jars of `ais`, by default the selected and extra AIs, and
+        loads the shared Java classes.
+
+        Each startup phase is timed into `startup_times`.
+        """
+        ais = self.ai2s + self.extra_ais if ais is None else ais
+        self.startup_times = {"jvm_start": launch_jvm(self.microrts_path, ais)}
+
+        start = time.perf_counter()
         from rts.units import UnitTypeTable
         self.real_utt = UnitTypeTable()
         from ai.rewardfunction import (  # CloserToEnemyBaseRewardFunction,
@@ -85,22 +216,7 @@ class MicroRTSGridModeVecEnv:
             ProduceCombatUnitRewardFunction(),
             # CloserToEnemyBaseRewardFunction(),
         ])
-        self.start_client()
-
-        self.num_planes = [5, 5, 3, len(self.utt['unitTypes'])+1, 6]
-        if partial_obs:
-            self.num_planes = [5, 5, 3, len(self.utt['unitTypes'])+1, 6, 2]
-        self.observation_space = gym.spaces.Box(low=0.0,
-            high=1.0,
-            shape=(self.height, self.width,
-                    sum(self.num_planes)),
-                    dtype=np.int32)
-        self.action_space = gym.spaces.MultiDiscrete([
-            self.height * self.width,
-            6, 4, 4, 4, 4,
-            len(self.utt['unitTypes']),
-            7 * 7
-        ])
+        self.startup_times["class_loading"] = time.perf_counter() - start
 
     def start_client(self) -> None:
         """Start Client to communicate with microRTS environment.
@@ -109,6 +225,7 @@ class MicroRTSGridModeVecEnv:
         """
         self.logger.debug("Initiatlize client")
 
+        start = time.perf_counter()
         from ai.core import AI
         from ts import JNIGridnetVecClient as Client
         self.vec_client = Client(
@@ -123,50 +240,384 @@ class MicroRTSGridModeVecEnv:
             self.partial_obs,
         )
         self.render_client = self.vec_client.selfPlayClients[0] if len(self.vec_client.selfPlayClients) > 0 else self.vec_client.clients[0]
+        self.startup_times["client_construction"] = time.perf_counter() - start
         # get the unit type table
+        start = time.perf_counter()
         self.utt = json.loads(str(self.render_client.sendUTT()))
+        self.startup_times["utt_fetch"] = time.perf_counter() - start
 
     def reset(self):
         self.logger.debug("Reseting environment")
-        responses = self.vec_client.reset([0]*self.num_envs)
-        raw_obs = np.array(responses.observation)
-        reward = np.array(responses.reward)
-        done = np.array(responses.done)
+        if self._step_future is not None:
+            self.step_wait()
+        self._apply_opponents(list(self._pending_opponents))
+        with self.stats.time("reset"):
+            responses = self.vec_client.reset([0]*self.num_envs)
+        self._apply_maps(list(self._pending_maps))
+        self._action_masks.clear()
+        with self.stats.time("transfer"):
+            raw_obs = self._raw_obs(responses.observation)
         info = {}
-        obs = []
-        for ro in raw_obs:
-            obs += [self._encode_obs(ro)]
-        return np.array(obs)
+        with self.stats.time("encode"):
+            return self._encode_obs(raw_obs)
+
+    def _env_client(self, env_idx):
+        """Returns the Java client running env `env_idx` and the player the env controls.
+
+        Selfplay envs come in pairs sharing one client, bot envs follow after them.
+        """
+        if env_idx < self.num_selfplay_envs:
+            return self.vec_client.selfPlayClients[env_idx // 2], env_idx % 2
+        return self.vec_client.clients[env_idx - self.num_selfplay_envs], 0
+
+    def _map_size(self, map_path):
+        """Returns the height and width of a map, parsed only once."""
+        if map_path not in self._map_sizes:
+            self._map_sizes[map_path] = read_map_size(map_path)
+        return self._map_sizes[map_path]
+
+    def _update_map_layout(self):
+        """Locates the map of every env in the padded `height` x `width` grid.
+
+        `valid_cells` (num_envs, height, width) marks the cells on the map of each env. Padding
+        is added below and right of smaller maps, their padded cells are all zero in the
+        observations and masks, and `_cell_remap` translates padded cell indices into the
+        indices of the env's own map (-1 for padding).
+        """
+        sizes = np.array([self._map_size(path) for path in self.map_paths]).reshape(-1, 2)
+        ys, xs = np.divmod(np.arange(self.height * self.width), self.width)
+        valid = (ys < sizes[:, [0]]) & (xs < sizes[:, [1]])
+        self.valid_cells = valid.reshape(self.num_envs, self.height, self.width)
+        self._cell_remap = np.where(valid, ys * sizes[:, [1]] + xs, -1).astype(np.int32)
+        self._env_map_sizes = sizes
+        self._padded = not valid.all()
+
+    def set_maps(self, per_env_paths):
+        """Plays `per_env_paths[i]` in env i from its next reset on.
+
+        The JVM and the clients stay alive, only the `mapPath` of the clients changes. The
+        clients load their map from `mapPath` on every reset, so a Java-side map cache would
+        need a client change. Map sizes are parsed once on the Python side. Both envs of a
+        selfplay pair play on the same map.
+        Maps smaller than the grid of the env are padded, see `_update_map_layout`. Like the
+        game, the padding of an env switches to the new map when the env restarts, i.e. when
+        it is done or on `reset`/`reset_envs`; `map_paths` holds the maps currently played.
+        """
+        assert len(per_env_paths) == self.num_envs, "for each environment, a map should be provided"
+        for env_idx, map_path in enumerate(per_env_paths):
+            height, width = self._map_size(map_path)
+            if height > self.height or width > self.width:
+                raise ValueError(f"{map_path} is {height}x{width}, larger than the {self.height}x{self.width} grid of this env")
+            if env_idx < self.num_selfplay_envs and env_idx % 2 == 1:
+                assert map_path == per_env_paths[env_idx - 1], "both envs of a selfplay pair need the same map"
+        # a pending step may restart games, the new maps only apply to the resets after it
+        self._wait_for_step()
+        for env_idx, map_path in enumerate(per_env_paths):
+            if map_path == self.map_paths[env_idx]:
+                self._pending_maps.pop(env_idx, None)
+            else:
+                self._pending_maps[env_idx] = map_path
+            client, _ = self._env_client(env_idx)
+            client.mapPath = os.path.join(self.microrts_path, map_path)
+
+    def _apply_maps(self, env_indices):
+        """Switches the layout of the restarted envs `env_indices` to their pending maps."""
+        applied = [env_idx for env_idx in env_indices if env_idx in self._pending_maps]
+        for env_idx in applied:
+            self.map_paths[env_idx] = self._pending_maps.pop(env_idx)
+        if applied:
+            self._update_map_layout()
+
+    def _wait_for_step(self):
+        """Blocks until a step dispatched by `step_async` finished, without taking its result.
+
+        The Java client is not thread-safe, so it must not be called while `gameStep` runs.
+        """
+        if self._step_future is not None:
+            wait([self._step_future])
+
+    def set_opponents(self, env_indices, ai_factories):
+        """Lets bot env `env_indices[i]` play against `ai_factories[i]` from its next reset on.
 
-    def _encode_obs(self, obs):
-        obs = obs.reshape(len(obs), -1).clip(0, np.array([self.num_planes]).T-1)
-        obs_planes = np.zeros((self.height * self.width, sum(self.num_planes)), dtype=np.int)
-        obs_planes[np.arange(len(obs_planes)),obs[0]] = 1
+        Indices count all envs, so bot envs start at `num_selfplay_envs`. The swap happens
+        when the env finishes its episode or on `reset`, without touching the other envs.
+        AI instances are cached per env and factory, so rotating back to an opponent reuses it.
+        The jars of the AIs must be loaded already, pass all candidate opponents as `extra_ais`.
+        """
+        assert len(env_indices) == len(ai_factories), "for each environment, a microrts ai should be provided"
+        # fails early if the JVM was started without the jars of these AIs
+        launch_jvm(self.microrts_path, ai_factories)
+        for env_idx, ai_factory in zip(env_indices, ai_factories):
+            if not self.num_selfplay_envs <= env_idx < self.num_envs:
+                raise ValueError(f"env {env_idx} is not a bot env")
+            self._pending_opponents[env_idx] = ai_factory
+
+    def _apply_opponents(self, env_indices):
+        for env_idx in env_indices:
+            ai_factory = self._pending_opponents.pop(env_idx)
+            key = (env_idx, ai_factory)
+            if key not in self._opponent_cache:
+                self._opponent_cache[key] = ai_factory(self.real_utt)
+            ai = self._opponent_cache[key]
+            ai.reset()
+            client, _ = self._env_client(env_idx)
+            client.ai2 = ai
+            self.ai2s[env_idx - self.num_selfplay_envs] = ai_factory
 
-        for i in range(1, len(self.num_planes)):
-            obs_planes[np.arange(len(obs_planes)),obs[i]+sum(self.num_planes[:i])] = 1
-        return obs_planes.reshape(self.height, self.width, -1)
+    def reset_envs(self, env_indices):
+        """Resets only the envs in `env_indices` and returns their encoded observations.
+
+        Resetting one env of a selfplay pair restarts the game of both players.
+        """
+        if self._step_future is not None:
+            self.step_wait()
+        raw_obs = []
+        self._apply_opponents([env_idx for env_idx in env_indices if env_idx in self._pending_opponents])
+        for env_idx in env_indices:
+            client, player = self._env_client(env_idx)
+            raw_obs.append(client.reset(player).observation)
+        # resetting one env of a selfplay pair restarts the other one too
+        restarted = set(env_indices) | {env_idx ^ 1 for env_idx in env_indices if env_idx < self.num_selfplay_envs}
+        self._apply_maps(sorted(restarted))
+        self._action_masks.clear()
+        return self._encode_obs(self._raw_obs(raw_obs, env_indices), env_indices, fresh=True)
+
+    def snapshot(self, env_indices):
+        """Saves the games of `env_indices` and returns one `GameSnapshot` per env.
+
+        Both envs of a selfplay pair play the same game, so their snapshots hold the same state.
+        """
+        if self._step_future is not None:
+            self.step_wait()
+        handles = []
+        for env_idx in env_indices:
+            client, _ = self._env_client(env_idx)
+            ai2 = client.ai2.clone() if env_idx >= self.num_selfplay_envs else None
+            handles.append(GameSnapshot(env_idx, self.map_paths[env_idx], client.gs.clone(), ai2))
+        return handles
+
+    def restore(self, handles, env_indices=None):
+        """Continues the game of `handles[i]` in env `env_indices[i]`, by default the env it was
+        saved from, and returns the encoded observations of these envs.
+
+        A snapshot can be restored into any env on a map of the same size. Restoring into a
+        selfplay env restores the game of its pair. The opponent AI of a bot env is restored
+        too when the snapshot was taken in a bot env.
+        """
+        assert not self.partial_obs, "restoring observations is only supported with full observability"
+        env_indices = [handle.env_idx for handle in handles] if env_indices is None else list(env_indices)
+        assert len(handles) == len(env_indices), "for each environment, a snapshot should be provided"
+        if self._step_future is not None:
+            self.step_wait()
+        for handle, env_idx in zip(handles, env_indices):
+            if self._map_size(handle.map_path) != self._map_size(self.map_paths[env_idx]):
+                raise ValueError(f"Cannot restore a game on {handle.map_path} in env {env_idx} playing on {self.map_paths[env_idx]}")
+            client, _ = self._env_client(env_idx)
+            client.gs = handle.game_state.clone()
+            # the masks and actions of the client read the board through `pgs`
+            client.pgs = client.gs.getPhysicalGameState()
+            if handle.ai2 is not None and env_idx >= self.num_selfplay_envs:
+                client.ai2 = handle.ai2.clone()
+        self._action_masks.clear()
+        raw_obs = []
+        for env_idx in env_indices:
+            client, player = self._env_client(env_idx)
+            raw_obs.append(client.gs.getVectorObservation(player))
+        return self._encode_obs(self._raw_obs(raw_obs, env_indices), env_indices, fresh=True)
+
+    def fork(self, handle, env_indices):
+        """Restores one snapshot into all `env_indices`, e.g. to try K candidate actions from
+        one state with a single batched `step`, and returns their observations."""
+        return self.restore([handle] * len(env_indices), env_indices)
+
+    def _raw_obs(self, observation, env_indices=None):
+        """Converts the Java observations of `env_indices` (default all envs) into numpy.
+
+        The observation of each env is (len(num_planes), h, w), those of envs on smaller maps
+        are padded to the grid of the env.
+        """
+        env_indices = range(self.num_envs) if env_indices is None else env_indices
+        if not self._padded:
+            obs_shape = (len(self.num_planes), self.height, self.width)
+            if isinstance(observation, list):
+                return np.stack([java_to_numpy(obs, shape=obs_shape) for obs in observation])
+            return java_to_numpy(observation, shape=(-1,) + obs_shape)
+        raw_obs = np.zeros((len(env_indices), len(self.num_planes), self.height, self.width), dtype=np.int32)
+        for i, (obs, env_idx) in enumerate(zip(observation, env_indices)):
+            height, width = self._env_map_sizes[env_idx]
+            raw_obs[i, :, :height, :width] = java_to_numpy(obs).reshape(-1, height, width)
+        return raw_obs
+
+    def _encode_obs(self, obs, env_indices=None, fresh=False):
+        """Encodes the raw observations of all envs into `obs_format` in a single pass.
+
+        `obs` has shape (num_envs, len(num_planes), height, width). Except for `packed`, the
+        result is written into one of two buffers that alternate between steps, so copy it if
+        it has to outlive the step after next. With `fresh=True` it is written into a new
+        array instead and the buffers of the steps are left alone.
+        """
+        obs = obs.reshape(len(obs), len(self.num_planes), -1).clip(0, self._plane_max)
+        if fresh:
+            obs_planes = np.empty_like(self._obs_buffers[0][:len(obs)])
+        else:
+            self._obs_buffer_idx = 1 - self._obs_buffer_idx
+            obs_planes = self._obs_buffers[self._obs_buffer_idx][:len(obs)]
+        if self.obs_format == "planes":
+            # padded cells are all zero in the raw observations already
+            obs_planes[:] = obs.transpose(0, 2, 1)
+            return obs_planes.reshape(len(obs), self.height, self.width, -1)
+        obs_planes.fill(0)
+        np.put_along_axis(obs_planes, (obs + self._plane_offsets).transpose(0, 2, 1), 1, axis=2)
+        if self._padded:
+            env_indices = slice(None) if env_indices is None else env_indices
+            obs_planes *= self.valid_cells.reshape(self.num_envs, -1, 1)[env_indices]
+        obs_planes = obs_planes.reshape(len(obs), self.height, self.width, -1)
+        if self.obs_format == "packed":
+            return np.packbits(obs_planes, axis=-1)
+        return obs_planes
+
+    def to_planes(self, obs):
+        """Returns the uint8 index of every feature (n, height, width, len(num_planes)) of
+        observations in the `obs_format` of this env."""
+        if self.obs_format == "planes":
+            return obs
+        if self.obs_format == "packed":
+            obs = np.unpackbits(obs, axis=-1, count=sum(self.num_planes))
+        return onehot_to_planes(obs, self.num_planes)
+
+    def to_onehot(self, obs, dtype=np.uint8):
+        """Returns the one-hot planes (n, height, width, sum(num_planes)) of observations in
+        the `obs_format` of this env. Padded cells of `planes` observations are not zeroed."""
+        if self.obs_format == "planes":
+            return planes_to_onehot(obs, self.num_planes, dtype)
+        if self.obs_format == "packed":
+            return np.unpackbits(obs, axis=-1, count=sum(self.num_planes)).astype(dtype)
+        return obs.astype(dtype, copy=False)
+
+    def get_action_mask(self, packed=False):
+        """Returns the action masks of all envs as a (num_envs, height, width, 79) bool array.
+
+        The first value of the last axis masks the source unit and the remaining 78 mask
+        the parameters of `action_space` after the source unit. With `packed=True` the last
+        axis is bit-packed with `np.packbits` into uint8. The masks are fetched from the JVM
+        once and cached until the next `step` or `reset`. While a step dispatched by
+        `step_async` is pending, this waits for it and returns the masks of its new state.
+        """
+        if False not in self._action_masks:
+            self._wait_for_step()
+            masks = self.vec_client.getMasks(0)
+            if self._padded:
+                padded = np.zeros((self.num_envs, self.height, self.width, 1 + sum(self.action_space.nvec[1:])), dtype=np.bool_)
+                # clients allocate their mask buffer for the map they were built on, `map_path`,
+                # and only fill the cells of their current map
+                built_height, built_width = self._map_size(self.map_path)
+                for env_idx, mask in enumerate(masks):
+                    height, width = self._env_map_sizes[env_idx]
+                    mask = java_to_numpy(mask).reshape(-1, padded.shape[-1])
+                    mask_width = built_width if len(mask) == built_height * built_width else width
+                    padded[env_idx, :height, :width] = mask.reshape(-1, mask_width, mask.shape[-1])[:height, :width]
+                self._action_masks[False] = padded
+            else:
+                self._action_masks[False] = java_to_numpy(masks, shape=(self.num_envs, self.height, self.width, -1)).astype(np.bool_)
+        if packed and True not in self._action_masks:
+            self._action_masks[True] = np.packbits(self._action_masks[False], axis=-1)
+        return self._action_masks[packed]
+
+    def _to_java_actions(self, actions):
+        """Converts dense gridnet actions into the per-unit Java arrays `gameStep` expects.
+
+        `actions` has shape (num_envs, height * width, 7), one action for every cell without
+        the source unit component. Only cells selected by the source unit mask are sent and each
+        env is handed to the JVM as one primitive array. Lists are passed through unchanged,
+        except that source units of envs on padded maps are translated into map coordinates.
+        The attack target is relative to the unit and needs no translation.
+        """
+        if not isinstance(actions, np.ndarray):
+            if not self._padded:
+                return actions
+            return [
+                [[int(self._cell_remap[env_idx][action[0]])] + list(action[1:]) for action in env_actions]
+                for env_idx, env_actions in enumerate(actions)
+            ]
+        actions = actions.reshape(self.num_envs, self.height * self.width, -1)
+        source_unit_idxs = np.broadcast_to(self._source_unit_idxs, actions.shape[:2] + (1,))
+        actions = np.concatenate((source_unit_idxs, actions), axis=2).astype(np.int32)
+        source_unit_mask = self.get_action_mask()[..., 0].reshape(self.num_envs, -1)
+        java_actions = []
+        for env_actions, env_mask, remap in zip(actions, source_unit_mask, self._cell_remap):
+            env_actions = env_actions[env_mask]
+            if self._padded:
+                env_actions[:, 0] = remap[env_actions[:, 0]]
+            java_actions.append(JArray.of(env_actions) if len(env_actions) else JArray(JInt, 2)(0))
+        return JArray(JInt, 3)(java_actions)
 
     def step_async(self, actions):
-        self.actions = actions
+        """Dispatches `gameStep` and the encoding of its results to a background thread.
 
-    def step_wait(self):
+        The JVM simulates while the caller keeps working, e.g. on policy inference for another
+        batch.
+        """
+        if self._step_future is not None:
+            raise RuntimeError("step_async called again before step_wait")
+        with self.stats.time("actions"):
+            self.actions = self._to_java_actions(actions)
+        self._action_masks.clear()
+        self._step_future = self._executor.submit(self._game_step, self.actions)
+
+    def _game_step(self, actions):
         e = [0 for _ in range(self.num_envs)]
-        self.logger.info(self.actions)
-        self.logger.info(e)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("gameStep actions %s players %s", actions, e)
 
-        responses = self.vec_client.gameStep(self.actions, e)
-        raw_obs, reward, done = np.array(responses.observation), np.array(responses.reward), np.array(responses.done)
-        obs = []
-        for ro in raw_obs:
-            obs += [self._encode_obs(ro)]
-        infos = [{"raw_rewards": item} for item in reward]
-        return np.array(obs), reward @ self.reward_weight, done[:,0], infos
+        reward = None
+        for tick in range(self.frame_skip + 1):
+            if tick > 0 and not self.repeat_actions:
+                actions = [[] for _ in range(self.num_envs)]
+            with self.stats.time("gameStep"):
+                responses = self.vec_client.gameStep(actions, e)
+            with self.stats.time("transfer"):
+                tick_reward = java_to_numpy(responses.reward, shape=(self.num_envs, -1))
+                done = java_to_numpy(responses.done, shape=(self.num_envs, -1))
+                # the reward buffer may be reused by the next tick, sum into a copy
+                reward = tick_reward.astype(np.float64) if reward is None else reward + tick_reward
+            if done[:, 0].any():
+                break
+        if self._pending_maps:
+            # finished games were restarted by gameStep on their new map, so are their observations
+            self._apply_maps(np.flatnonzero(done[:, 0]))
+        with self.stats.time("transfer"):
+            raw_obs = self._raw_obs(responses.observation)
+        with self.stats.time("encode"):
+            obs = self._encode_obs(raw_obs)
+        with self.stats.time("infos"):
+            infos = [{"raw_rewards": item} for item in reward]
+            return obs, reward @ self.reward_weight, done[:,0], infos
+
+    def step_wait(self):
+        future, self._step_future = self._step_future, None
+        with self.stats.time("step_wait"):
+            result = future.result()
+        if self._pending_opponents:
+            # finished games were restarted by gameStep, their new opponent acts from the first tick
+            done = result[2]
+            self._apply_opponents([env_idx for env_idx in self._pending_opponents if done[env_idx]])
+        return result
 
     def step(self, ac):
         self.step_async(ac)
         return self.step_wait()
     
+    def get_stats(self):
+        """Returns the duration histograms of the phases of `reset`, `step` and `render`.
+
+        Phases are `actions` (conversion of the actions), `gameStep`, `reset` and `render`
+        (the Java calls), `transfer` (Java to numpy), `encode` (one-hot encoding), `infos`
+        and `step_wait` (time blocked on the step). Every phase maps to its `count`, `sum` and
+        `mean` in seconds and the number of observations per bucket. Empty unless the env was
+        created with `instrument=True`.
+        """
+        return self.stats.snapshot()
+
     def seed(self, seed) -> None:
         """Sets seed for random value generator.
 
@@ -188,17 +639,34 @@ class MicroRTSGridModeVecEnv:
             return None
 
     def render(self, mode="human"):
-        if mode == "human":
-            self.render_client.render(False)
-        elif mode == 'rgb_array':
-            bytes_array = np.array(self.render_client.render(True))
-            image = Image.frombytes("RGB", (640, 640), bytes_array)
-            return np.array(image)[:,:,::-1]
-
-    def close(self):
+        self._wait_for_step()
+        with self.stats.time("render"):
+            if mode == "human":
+                self.render_client.render(False)
+            elif mode == 'rgb_array':
+                bytes_array = np.array(self.render_client.render(True))
+                image = Image.frombytes("RGB", (640, 640), bytes_array)
+                return np.array(image)[:,:,::-1]
+
+    def render_frames(self, obs, cell_size=16, height=None, width=None):
+        """Draws RGB frames of all envs from their observations `obs` without calling the JVM.
+
+        Returns (num_envs, height, width, 3) uint8 frames, see `gym_microrts.rendering`. Use
+        `rendering.mosaic` to tile them into one image.
+        """
+        with self.stats.time("render_frames"):
+            if self.obs_format in ("onehot", "onehot_uint8"):
+                return rendering.render_frames(obs, self.num_planes, cell_size, height, width)
+            valid = self.valid_cells if self._padded and len(obs) == self.num_envs else None
+            return rendering.render_planes(self.to_planes(obs), cell_size, height, width, valid=valid)
+
+    def close(self, shutdown_jvm=True):
         """Closes clients.
         This method should be used once the experiment is finished.
+        Pass `shutdown_jvm=False` to keep the JVM running for other envs in this process.
         """
+        self._executor.shutdown(wait=True)
         if jpype._jpype.isStarted():
             self.vec_client.close()
-            jpype.shutdownJVM()
+            if shutdown_jvm:
+                jpype.shutdownJVM()
@@ -0,0 +1,95 @@
+import logging
+import os
+import shlex
+import time
+
+import jpype
+import jpype.imports
+from gym_microrts import microrts_ai
+from jpype.imports import registerDomain
+
+JARS = [
+    "microrts.jar", "Coac.jar", "Droplet.jar", "GRojoA3N.jar",
+    "Izanagi.jar", "MixedBot.jar", "RojoBot.jar", "TiamatBot.jar", "UMSBot.jar" # "MindSeal.jar"
+]
+# class-data-sharing archive the build can dump next to microrts.jar, see `dump_cds_archive`
+CDS_ARCHIVE = "microrts.jsa"
+
+logger = logging.getLogger("MicroRTSJVM")
+
+
+def required_jars(ais):
+    """Returns the jars the given `microrts_ai` factories need, microrts.jar first.
+
+    Factories not defined in `microrts_ai` may come from any competition jar, so they
+    pull in all of `JARS`.
+    """
+    jars = ["microrts.jar"]
+    for ai in ais:
+        if getattr(ai, "__module__", None) != microrts_ai.__name__:
+            return list(JARS)
+        jars += [jar for jar in microrts_ai.AI_JARS.get(ai.__name__, []) if jar not in jars]
+    return jars
+
+
+def launch_jvm(microrts_path, ais=()):
+    """Starts the JVM with only the jars needed by `ais` and returns the time it took.
+
+    The classpath cannot change once the JVM runs, which allows only one JVM per process,
+    so envs created later that need other jars raise a RuntimeError. Pass every AI the
+    process will use to the first env, e.g. through its `extra_ais`, or set
+    `MICRORTS_ALL_JARS=1` to always load all of `JARS`. When the build dumped a
+    class-data-sharing archive it is used to speed up class loading. Extra JVM options can
+    be passed through the `MICRORTS_JVM_ARGS` environment variable.
+    """
+    all_jars = os.environ.get("MICRORTS_ALL_JARS", "").lower() in ("1", "true", "yes")
+    jars = [os.path.join(microrts_path, jar) for jar in (JARS if all_jars else required_jars(ais))]
+    start = time.perf_counter()
+    if jpype._jpype.isStarted():
+        # the same jar may be reached through another path, e.g. a symlinked install
+        classpath = {os.path.realpath(path) for path in jpype.getClassPath().split(os.pathsep)}
+        missing = [jar for jar in jars if os.path.realpath(jar) not in classpath]
+        if missing:
+            raise RuntimeError(
+                f"The JVM was started without {missing}, pass these AIs to the first env as `extra_ais` "
+                "or set MICRORTS_ALL_JARS=1")
+        return 0.0
+
+    registerDomain("ts", alias="tests")
+    registerDomain("ai")
+    for jar in jars:
+        jpype.addClassPath(jar)
+    jvm_args = shlex.split(os.environ.get("MICRORTS_JVM_ARGS", ""))
+    archive = os.path.join(microrts_path, CDS_ARCHIVE)
+    if os.path.exists(archive) and not any(arg.startswith("-XX:ArchiveClassesAtExit") for arg in jvm_args):
+        jvm_args += ["-Xshare:auto", f"-XX:SharedArchiveFile={archive}"]
+    jpype.startJVM(*jvm_args, convertStrings=False)
+    elapsed = time.perf_counter() - start
+    logger.debug("Started JVM in %.3fs with classpath %s", elapsed, jars)
+    return elapsed
+
+
+def dump_cds_archive(microrts_path, map_path="maps/10x10/basesTwoWorkers10x10.xml"):
+    """Runs a short game in a fresh JVM that dumps its loaded classes into `CDS_ARCHIVE`.
+
+    Needs JDK 13+ for `-XX:ArchiveClassesAtExit`. Only microrts.jar is on the classpath
+    so the archive stays valid for every classpath that `launch_jvm` builds.
+    """
+    from gym_microrts.envs.grid_mode_vec_env import MicroRTSGridModeVecEnv
+
+    os.environ["MICRORTS_JVM_ARGS"] = "-XX:ArchiveClassesAtExit=" + os.path.join(microrts_path, CDS_ARCHIVE)
+    env = MicroRTSGridModeVecEnv(
+        num_selfplay_envs=2,
+        num_bot_envs=1,
+        ai2s=[microrts_ai.passiveAI],
+        map_path=map_path,
+    )
+    env.reset()
+    for _ in range(10):
+        env.step([[] for _ in range(env.num_envs)])
+    env.close()
+
+
+if __name__ == "__main__":
+    import gym_microrts
+    dump_cds_archive(os.path.join(gym_microrts.__path__[0], "microrts"))
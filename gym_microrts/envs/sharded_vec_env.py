@@ -0,0 +1,220 @@
+import logging
+import multiprocessing as mp
+
+import numpy as np
+
+from .grid_mode_vec_env import MicroRTSGridModeVecEnv, grid_size
+
+
+def _worker(remote, parent_remote, env_kwargs, selfplay_slice, bot_slice):
+    """Runs one MicroRTSGridModeVecEnv (and so one JVM) inside a worker process.
+
+    Results are written straight into the shared memory views of the parent, the pipe only
+    carries commands and small acknowledgements.
+    """
+    parent_remote.close()
+    env = MicroRTSGridModeVecEnv(**env_kwargs)
+    num_selfplay = selfplay_slice.stop - selfplay_slice.start
+
+    def gather(arr):
+        return np.concatenate((arr[selfplay_slice], arr[bot_slice]))
+
+    def scatter(dst, src):
+        dst[selfplay_slice] = src[:num_selfplay]
+        dst[bot_slice] = src[num_selfplay:]
+
+    remote.send({
+        "observation_space": env.observation_space,
+        "action_space": env.action_space,
+        "obs_dtype": env.observation_space.dtype,
+        "mask_shape": (env.height, env.width, 1 + int(sum(env.action_space.nvec[1:]))),
+        "num_rewards": len(env.rfs),
+    })
+    from multiprocessing.shared_memory import SharedMemory
+    shms, bufs = [], {}
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "attach":
+                for name, (shm_name, shape, dtype) in data.items():
+                    shms.append(SharedMemory(name=shm_name))
+                    bufs[name] = np.ndarray(shape, dtype=dtype, buffer=shms[-1].buf)
+                remote.send(None)
+            elif cmd == "reset":
+                scatter(bufs["obs"][data], env.reset())
+                scatter(bufs["masks"][data], env.get_action_mask())
+                remote.send(None)
+            elif cmd == "step":
+                slot, actions = data
+                if actions is None:
+                    actions = gather(bufs["actions"])
+                obs, reward, done, infos = env.step(actions)
+                scatter(bufs["obs"][slot], obs)
+                scatter(bufs["reward"][slot], reward)
+                scatter(bufs["done"][slot], done)
+                scatter(bufs["raw_rewards"][slot], np.array([info["raw_rewards"] for info in infos]))
+                scatter(bufs["masks"][slot], env.get_action_mask())
+                remote.send(None)
+            elif cmd == "seed":
+                remote.send(env.seed(data))
+            elif cmd == "render":
+                remote.send(env.render(data))
+            elif cmd == "close":
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bufs.clear()
+        for shm in shms:
+            shm.close()
+        env.close()
+        remote.close()
+
+
+class MicroRTSShardedVecEnv:
+    """Spreads the envs of a MicroRTSGridModeVecEnv over several worker processes.
+
+    jpype can only run one JVM per process, so every worker hosts its own JVM and
+    `JNIGridnetVecClient`. Observations, rewards, dones and action masks come back through
+    shared memory ring buffers of `buffer_depth` slots instead of being pickled: arrays
+    returned by `reset`/`step` are views into the current slot and remain valid for the
+    next `buffer_depth - 1` steps. The env order matches MicroRTSGridModeVecEnv, i.e. all
+    selfplay envs first, followed by the bot envs.
+
+    Workers are started with the `spawn` method, so scripts creating this env need an
+    `if __name__ == "__main__":` guard. Needs Python 3.8 or later.
+    """
+
+    def __init__(self,
+        num_selfplay_envs,
+        num_bot_envs,
+        num_workers=2,
+        ai2s=[],
+        buffer_depth=2,
+        **env_kwargs):
+        self.logger = logging.getLogger("MicroRTSShardedVecEnv")
+
+        assert num_selfplay_envs % 2 == 0, "selfplay envs are played in pairs"
+        assert num_bot_envs == len(ai2s), "for each environment, a microrts ai should be provided"
+        self.num_selfplay_envs = num_selfplay_envs
+        self.num_bot_envs = num_bot_envs
+        self.num_envs = num_selfplay_envs + num_bot_envs
+        self.buffer_depth = buffer_depth
+
+        # split selfplay pairs and bot envs as evenly as possible over the workers
+        pair_splits = np.array_split(np.arange(num_selfplay_envs // 2), num_workers)
+        bot_splits = np.array_split(np.arange(num_bot_envs), num_workers)
+        if env_kwargs.get("map_paths") is not None:
+            # every shard pads its envs to the grid of the largest map of all shards
+            env_kwargs["grid_size"] = grid_size(env_kwargs["map_paths"])
+        ctx = mp.get_context("spawn")
+        self.remotes, self.processes, self._slices = [], [], []
+        for pairs, bots in zip(pair_splits, bot_splits):
+            if len(pairs) + len(bots) == 0:
+                continue
+            selfplay_slice = slice(2 * pairs[0], 2 * (pairs[-1] + 1)) if len(pairs) else slice(0, 0)
+            bot_slice = slice(num_selfplay_envs + bots[0], num_selfplay_envs + bots[-1] + 1) if len(bots) else slice(0, 0)
+            kwargs = dict(env_kwargs,
+                num_selfplay_envs=2 * len(pairs),
+                num_bot_envs=len(bots),
+                ai2s=[ai2s[i] for i in bots])
+            if env_kwargs.get("map_paths") is not None:
+                map_paths = env_kwargs["map_paths"]
+                kwargs["map_paths"] = list(map_paths[selfplay_slice]) + list(map_paths[bot_slice])
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker,
+                args=(work_remote, remote, kwargs, selfplay_slice, bot_slice),
+                daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+            self._slices.append((selfplay_slice, bot_slice))
+
+        specs = [remote.recv() for remote in self.remotes]
+        assert all(s["mask_shape"] == specs[0]["mask_shape"] for s in specs), "all shards need the same grid"
+        spec = specs[0]
+        self.observation_space = spec["observation_space"]
+        self.action_space = spec["action_space"]
+        self.height, self.width = spec["mask_shape"][:2]
+
+        # allocate the shared buffers and let the workers attach to them
+        shapes = {
+            "obs": ((buffer_depth, self.num_envs) + self.observation_space.shape, spec["obs_dtype"]),
+            "reward": ((buffer_depth, self.num_envs), np.float64),
+            "done": ((buffer_depth, self.num_envs), np.bool_),
+            "raw_rewards": ((buffer_depth, self.num_envs, spec["num_rewards"]), np.float64),
+            "masks": ((buffer_depth, self.num_envs) + spec["mask_shape"], np.bool_),
+            "actions": ((self.num_envs, self.height * self.width, len(self.action_space.nvec) - 1), np.int32),
+        }
+        # shared memory needs Python 3.8, it is imported here so that the other envs run on 3.7
+        from multiprocessing.shared_memory import SharedMemory
+        self._shms, self._bufs, layout = [], {}, {}
+        for name, (shape, dtype) in shapes.items():
+            shm = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            self._shms.append(shm)
+            self._bufs[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            layout[name] = (shm.name, shape, dtype)
+        self._call("attach", layout)
+        self._slot = 0
+        self.closed = False
+
+    def _call(self, cmd, data=None):
+        for remote in self.remotes:
+            remote.send((cmd, data))
+        return [remote.recv() for remote in self.remotes]
+
+    def reset(self):
+        self._slot = (self._slot + 1) % self.buffer_depth
+        self._call("reset", self._slot)
+        return self._bufs["obs"][self._slot]
+
+    def step_async(self, actions):
+        self._slot = (self._slot + 1) % self.buffer_depth
+        if isinstance(actions, np.ndarray):
+            self._bufs["actions"][:] = actions.reshape(self._bufs["actions"].shape)
+            for remote in self.remotes:
+                remote.send(("step", (self._slot, None)))
+        else:
+            # ragged per-unit actions have to be pickled, send each worker only its envs
+            for remote, (selfplay_slice, bot_slice) in zip(self.remotes, self._slices):
+                remote.send(("step", (self._slot, list(actions[selfplay_slice]) + list(actions[bot_slice]))))
+
+    def step_wait(self):
+        for remote in self.remotes:
+            remote.recv()
+        slot = self._slot
+        infos = [{"raw_rewards": item} for item in self._bufs["raw_rewards"][slot]]
+        return self._bufs["obs"][slot], self._bufs["reward"][slot], self._bufs["done"][slot], infos
+
+    def step(self, ac):
+        self.step_async(ac)
+        return self.step_wait()
+
+    def get_action_mask(self, packed=False):
+        """Returns the action masks of all envs written by the workers after the last step/reset."""
+        masks = self._bufs["masks"][self._slot]
+        return np.packbits(masks, axis=-1) if packed else masks
+
+    def seed(self, seed) -> None:
+        self._call("seed", seed)
+        self.action_space.seed(seed)
+
+    def render(self, mode="human"):
+        """Renders the first env of the first worker."""
+        self.remotes[0].send(("render", mode))
+        return self.remotes[0].recv()
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self._bufs.clear()
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self.closed = True
@@ -79,4 +79,15 @@ ALL_AIS = [
     lightRushAI,
     coacAI,
     naiveMCTSAI,
-]
\ No newline at end of file
+]
+
+# Jars besides microrts.jar that the AIs above need on the classpath
+AI_JARS = {
+    "coacAI": ["Coac.jar"],
+    "mixedBot": ["MixedBot.jar"],
+    "rojo": ["RojoBot.jar"],
+    "izanagi": ["Izanagi.jar"],
+    "tiamat": ["TiamatBot.jar"],
+    "droplet": ["Droplet.jar"],
+    "guidedRojoA3N": ["GRojoA3N.jar"],
+}
@@ -0,0 +1,163 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+
+class EnvPool:
+    """Shares the envs of one vectorized environment between independent clients.
+
+    Every client holds one env slot. Step requests arriving within `window` seconds of the
+    first one are coalesced into a single `env.step`, so concurrent clients share one
+    `gameStep` call. A batch is sent as soon as every held slot submitted its actions or
+    the window expires. All calls into the environment run on one dedicated thread.
+
+    `gameStep` advances all envs, so a held slot that missed a batch advances one tick
+    without actions. Its rewards and dones of the missed ticks are not lost: they are added
+    to the result of its next step, whose info reports them as `missed_ticks`. A game that
+    ended during a missed tick is thus reported as done with its next result.
+    """
+
+    def __init__(self, env: Any, window: float = 0.005):
+        self.env = env
+        self.window = window
+        self.logger = logging.getLogger("EnvPool")
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="microrts-jvm")
+        self._cond = threading.Condition()
+        self._free = list(range(env.num_envs))
+        self._held = set()
+        self._pending: Dict[int, Tuple[Any, Future]] = {}
+        # number of the batch being collected, so that the timer of a sent batch does not cut the next one short
+        self._batch_id = 0
+        # reward, raw rewards, done and number of ticks a held slot missed
+        self._missed: Dict[int, Tuple[float, np.ndarray, bool, int]] = {}
+
+    def acquire(self) -> "PoolSlot":
+        "Raises IndexError if all slots are taken."
+        with self._cond:
+            if not self._free:
+                raise IndexError(f"All {self.env.num_envs} environment slots are in use")
+            index = self._free.pop(0)
+            self._held.add(index)
+        return PoolSlot(self, index)
+
+    def release(self, index: int) -> None:
+        with self._cond:
+            if index in self._held:
+                self._held.remove(index)
+                self._free.append(index)
+                self._missed.pop(index, None)
+                # a batch may be waiting only for this slot
+                self._send_if_complete()
+
+    def reset(self, index: int) -> np.ndarray:
+        with self._cond:
+            self._missed.pop(index, None)
+        return self.executor.submit(self.env.reset_envs, [index]).result()
+
+    def step(self, index: int, actions: Any) -> Tuple:
+        "Queues the actions of one slot and blocks until its batch was stepped."
+        future: Future = Future()
+        with self._cond:
+            if index in self._pending:
+                raise RuntimeError(f"Slot {index} already has a pending step")
+            self._pending[index] = (actions, future)
+            if len(self._pending) == 1:
+                timer = threading.Timer(self.window, self._window_expired, args=(self._batch_id,))
+                timer.daemon = True
+                timer.start()
+            self._send_if_complete()
+        return future.result()
+
+    def _window_expired(self, batch_id: int) -> None:
+        with self._cond:
+            if batch_id == self._batch_id and self._pending:
+                self._send()
+
+    def _send_if_complete(self) -> None:
+        "Sends the pending batch once every held slot is part of it, called with the lock held."
+        if self._pending and self._held <= set(self._pending):
+            self._send()
+
+    def _send(self) -> None:
+        batch, self._pending = self._pending, {}
+        self._batch_id += 1
+        self.executor.submit(self._step_batch, batch)
+
+    def _step_batch(self, batch: Dict[int, Tuple[Any, Future]]) -> None:
+        try:
+            obs, reward, done, infos = self.env.step(self._batch_actions(batch))
+        except Exception as e:
+            self.logger.exception("Coalesced step of %d slots failed", len(batch))
+            for _, future in batch.values():
+                future.set_exception(e)
+            return
+        with self._cond:
+            for index in self._held - set(batch):
+                self._add_missed(index, reward[index], infos[index]["raw_rewards"], done[index])
+            missed = {index: self._missed.pop(index) for index in batch if index in self._missed}
+        for index, (_, future) in batch.items():
+            slot_reward, slot_done, slot_infos = reward[index:index + 1], done[index:index + 1], infos[index:index + 1]
+            if index in missed:
+                missed_reward, missed_raw_rewards, missed_done, missed_ticks = missed[index]
+                slot_reward = slot_reward + missed_reward
+                slot_done = slot_done | missed_done
+                slot_infos = [dict(
+                    slot_infos[0],
+                    raw_rewards=slot_infos[0]["raw_rewards"] + missed_raw_rewards,
+                    missed_ticks=missed_ticks,
+                )]
+            future.set_result((obs[index:index + 1].copy(), slot_reward, slot_done, slot_infos))
+
+    def _add_missed(self, index: int, reward: float, raw_rewards: np.ndarray, done: bool) -> None:
+        total_reward, total_raw_rewards, any_done, ticks = self._missed.get(index, (0.0, 0.0, False, 0))
+        self._missed[index] = (total_reward + reward, total_raw_rewards + np.asarray(raw_rewards), any_done or bool(done), ticks + 1)
+
+    def _batch_actions(self, batch: Dict[int, Tuple[Any, Future]]) -> Any:
+        """Combines the actions of the slots into one batch for `env.step`.
+
+        Per-unit action lists are kept as lists, unless some slot sent dense gridnet actions,
+        in which case the lists are scattered into a dense array.
+        """
+        if not any(isinstance(actions, np.ndarray) for actions, _ in batch.values()):
+            return [batch[index][0] if index in batch else [] for index in range(self.env.num_envs)]
+        dense = np.zeros((self.env.num_envs, self.env.height * self.env.width, len(self.env.action_space.nvec) - 1), dtype=np.int32)
+        for index, (actions, _) in batch.items():
+            if isinstance(actions, np.ndarray):
+                dense[index] = actions.reshape(dense.shape[1:])
+            elif len(actions):
+                actions = np.asarray(actions)
+                dense[index, actions[:, 0]] = actions[:, 1:]
+        return dense
+
+    def close(self) -> None:
+        self.executor.submit(self.env.close, shutdown_jvm=False).result()
+        self.executor.shutdown(wait=True)
+
+
+class PoolSlot:
+    """One env of an EnvPool behaving like a vectorized environment with a single env."""
+
+    num_envs = 1
+
+    def __init__(self, pool: EnvPool, index: int):
+        self.pool = pool
+        self.index = index
+        self.observation_space = pool.env.observation_space
+        self.action_space = pool.env.action_space
+
+    def reset(self) -> np.ndarray:
+        return self.pool.reset(self.index)
+
+    def step(self, ac: Any) -> Tuple:
+        "`ac` holds the actions of the single env, like the batch of a vectorized env."
+        return self.pool.step(self.index, ac[0])
+
+    def seed(self, seed: int) -> None:
+        self.action_space.seed(seed)
+
+    def close(self, shutdown_jvm: bool = False) -> None:
+        "Frees the slot, the pooled environment keeps running."
+        self.pool.release(self.index)
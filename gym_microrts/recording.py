@@ -0,0 +1,239 @@
+"""Records the transitions of a vectorized environment into chunked, memory-mapped files.
+
+`TrajectoryRecorder` wraps a `MicroRTSGridModeVecEnv` and stores, for every step, the
+observation the actions were taken in, the action masks, the actions, the raw rewards and
+the dones of all envs. A recording is a directory
+
+    meta.json                 shapes, dtypes and the number of recorded steps
+    chunk_000000/obs.npy      (chunk_size, num_envs, h, w, ...) observations
+    chunk_000000/masks.npy    (chunk_size, num_envs, h, w, 10) bit-packed action masks
+    chunk_000000/actions.npy  (chunk_size, num_envs, h * w, 7) dense actions
+    chunk_000000/raw_rewards.npy, chunk_000000/dones.npy
+    chunk_000001/...
+
+Observations are stored as the categorical index of every feature (`planes`, one uint8 per
+feature instead of one value per plane) or as bit-packed one-hots (`packed`). The files
+are regular `.npy` files written through memory maps on a background thread, and
+`TrajectoryReader` reads them back without loading whole files.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+from typing import Any, Dict, Iterator, Optional
+
+import numpy as np
+
+from gym_microrts.utils import planes_to_onehot
+
+OBS_FORMATS = ("planes", "packed")
+FIELDS = ("obs", "masks", "actions", "raw_rewards", "dones")
+
+
+class TrajectoryRecorder:
+    """Wraps `env` and records every `step` into `directory`, see the module docstring.
+
+    Steps are queued to a writer thread, `max_queue` bounds the number of steps waiting
+    to be written before `step` blocks. Wrapping a `MicroRTSBotVecEnv` with `expert=True`
+    records the actions of its `ai1s` bots instead of the actions passed to `step`. Call
+    `close` to flush the recording; it does not close the wrapped env. Other attributes are
+    forwarded to `env`.
+    """
+
+    def __init__(self, env: Any, directory: str, chunk_size: int = 1024, obs_format: str = "planes", max_queue: int = 64):
+        if obs_format not in OBS_FORMATS:
+            raise ValueError(f"Unknown observation format '{obs_format}', expected one of {OBS_FORMATS}")
+        self.env = env
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.obs_format = obs_format
+        self.logger = logging.getLogger("TrajectoryRecorder")
+        self.num_steps = 0
+        self._last_obs: Optional[np.ndarray] = None
+        self._chunk: Dict[str, np.ndarray] = {}
+        self._error: Optional[BaseException] = None
+        os.makedirs(directory, exist_ok=True)
+
+        num_envs, height, width = env.num_envs, env.height, env.width
+        if obs_format == "planes":
+            obs_shape = (height, width, len(env.num_planes))
+        else:
+            obs_shape = (height, width, -(-sum(env.num_planes) // 8))
+        num_action_params = len(env.action_space.nvec) - 1
+        self.fields = {
+            "obs": (obs_shape, np.uint8),
+            "masks": ((height, width, -(-(1 + int(sum(env.action_space.nvec[1:]))) // 8)), np.uint8),
+            "actions": ((height * width, num_action_params), np.uint8),
+            "raw_rewards": ((len(env.reward_weight),), np.float32),
+            "dones": ((), np.bool_),
+        }
+        self.fields = {name: ((num_envs,) + shape, dtype) for name, (shape, dtype) in self.fields.items()}
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._writer = threading.Thread(target=self._write_loop, name="TrajectoryRecorder", daemon=True)
+        self._writer.start()
+
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+
+    def reset(self):
+        obs = self.env.reset()
+        self._last_obs = self._compact_obs(obs)
+        return obs
+
+    def step(self, actions):
+        if self._last_obs is None:
+            raise RuntimeError("Call reset before recording steps")
+        if self._error is not None:
+            raise RuntimeError("Writing the recording failed") from self._error
+        # masks of the observation the actions are taken in, cached by the env until the step
+        masks = self.env.get_action_mask(packed=True).copy()
+        dense_actions = self._dense_actions(actions)
+        obs, reward, done, infos = self.env.step(actions)
+        if getattr(self.env, "expert", False):
+            # demonstrations of a bot env, record the actions the bots took
+            dense_actions = self.env.get_expert_actions().astype(self.fields["actions"][1])
+        self._queue.put({
+            "obs": self._last_obs,
+            "masks": masks,
+            "actions": dense_actions,
+            "raw_rewards": np.array([info["raw_rewards"] for info in infos], dtype=np.float32),
+            "dones": np.asarray(done, dtype=np.bool_),
+        })
+        self.num_steps += 1
+        self._last_obs = self._compact_obs(obs)
+        return obs, reward, done, infos
+
+    def close(self) -> None:
+        "Writes the queued steps and the metadata."
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._write_meta()
+
+    def _compact_obs(self, obs: np.ndarray) -> np.ndarray:
+        "Copies `obs`, which is in the `obs_format` of the env, into the format of the recording."
+        if self.obs_format == "planes":
+            return np.array(self.env.to_planes(obs), dtype=np.uint8)
+        if self.env.obs_format == "packed":
+            return obs.copy()
+        return np.packbits(self.env.to_onehot(obs), axis=-1)
+
+    def _dense_actions(self, actions) -> np.ndarray:
+        "Scatters per-unit action lists into the dense (num_envs, h * w, 7) gridnet layout."
+        shape, dtype = self.fields["actions"]
+        if isinstance(actions, np.ndarray):
+            return actions.reshape(shape).astype(dtype)
+        dense = np.zeros(shape, dtype=dtype)
+        for env_idx, env_actions in enumerate(actions):
+            if len(env_actions):
+                env_actions = np.asarray(env_actions)
+                dense[env_idx, env_actions[:, 0]] = env_actions[:, 1:]
+        return dense
+
+    def _write_loop(self) -> None:
+        step = 0
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                index = step % self.chunk_size
+                if index == 0:
+                    self._open_chunk(step // self.chunk_size)
+                for name, value in item.items():
+                    self._chunk[name][index] = value
+                step += 1
+                if index == self.chunk_size - 1:
+                    self._flush_chunk()
+        except BaseException as e:
+            self.logger.exception("Writing the recording failed at step %d", step)
+            self._error = e
+            # keep draining so `step` does not block on a full queue
+            while self._queue.get() is not None:
+                pass
+        finally:
+            self._flush_chunk()
+
+    def _open_chunk(self, chunk_idx: int) -> None:
+        path = os.path.join(self.directory, f"chunk_{chunk_idx:06d}")
+        os.makedirs(path, exist_ok=True)
+        self._chunk = {
+            name: np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode="w+", dtype=dtype, shape=(self.chunk_size,) + shape)
+            for name, (shape, dtype) in self.fields.items()
+        }
+
+    def _flush_chunk(self) -> None:
+        for memmap in self._chunk.values():
+            memmap.flush()
+        self._chunk = {}
+
+    def _write_meta(self) -> None:
+        meta = {
+            "num_steps": self.num_steps,
+            "chunk_size": self.chunk_size,
+            "obs_format": self.obs_format,
+            "num_planes": list(self.env.num_planes),
+            "action_nvec": self.env.action_space.nvec.tolist(),
+            "fields": {name: {"shape": list(shape), "dtype": np.dtype(dtype).str} for name, (shape, dtype) in self.fields.items()},
+        }
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+
+class TrajectoryReader:
+    """Reads a recording of `TrajectoryRecorder`.
+
+    `reader[t]` returns the fields of step `t` for all envs and iterating yields the steps
+    in order; chunk files are memory-mapped and only the accessed steps are read. Use
+    `onehot` to turn stored observations back into the one-hot layout of the env.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.num_steps = self.meta["num_steps"]
+        self.chunk_size = self.meta["chunk_size"]
+        self.num_planes = self.meta["num_planes"]
+        self._chunks: Dict[int, Dict[str, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return self.num_steps
+
+    def __getitem__(self, step: int) -> Dict[str, np.ndarray]:
+        if step < 0:
+            step += self.num_steps
+        if not 0 <= step < self.num_steps:
+            raise IndexError(f"step {step} out of range for a recording of {self.num_steps} steps")
+        chunk = self.chunk(step // self.chunk_size)
+        return {name: values[step % self.chunk_size] for name, values in chunk.items()}
+
+    def __iter__(self) -> Iterator[Dict[str, np.ndarray]]:
+        for step in range(self.num_steps):
+            yield self[step]
+
+    @property
+    def num_chunks(self) -> int:
+        return -(-self.num_steps // self.chunk_size)
+
+    def chunk(self, chunk_idx: int) -> Dict[str, np.ndarray]:
+        "Returns the memory-mapped fields of a chunk, cut to the recorded steps."
+        if chunk_idx not in self._chunks:
+            path = os.path.join(self.directory, f"chunk_{chunk_idx:06d}")
+            length = min(self.chunk_size, self.num_steps - chunk_idx * self.chunk_size)
+            self._chunks[chunk_idx] = {
+                name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")[:length] for name in FIELDS
+            }
+        return self._chunks[chunk_idx]
+
+    def onehot(self, obs: np.ndarray, dtype=np.uint8) -> np.ndarray:
+        "Expands stored observations into the one-hot layout of the env."
+        if self.meta["obs_format"] == "planes":
+            return planes_to_onehot(obs, self.num_planes, dtype)
+        return np.unpackbits(obs, axis=-1, count=sum(self.num_planes)).astype(dtype)
+
+    def masks(self, masks: np.ndarray) -> np.ndarray:
+        "Unpacks stored action masks into bools."
+        return np.unpackbits(masks, axis=-1, count=1 + sum(self.meta["action_nvec"][1:])).astype(np.bool_)
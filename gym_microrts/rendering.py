@@ -0,0 +1,110 @@
+"""Renders RGB frames of many envs at once straight from their observations.
+
+Frames are drawn with vectorized numpy from the unit type and owner planes, so unlike
+`render("rgb_array")` there is no round trip to the Java client, e.g.
+
+    obs = env.step(actions)[0]
+    frames = render_frames(obs, env.num_planes, cell_size=8)  # (num_envs, 8 * h, 8 * w, 3)
+    image = mosaic(frames)
+
+`render_planes` draws observations in the `planes` format, i.e. the index of each feature.
+
+Cells are filled with the color of their unit type and units are outlined with the color of
+their owner, following the colors of the microRTS viewer. Cells of padded envs, i.e. outside
+the map of the env, are left dark.
+"""
+from typing import List, Optional
+
+import numpy as np
+
+from gym_microrts.utils import onehot_to_planes
+
+# none, resource, base, barracks, worker, light, heavy, ranged
+UNIT_COLORS = np.array([
+    [0, 0, 0], [0, 255, 0], [255, 255, 255], [192, 192, 192],
+    [128, 128, 128], [255, 128, 0], [255, 255, 0], [0, 255, 255],
+], dtype=np.uint8)
+# none, player 0, player 1
+OWNER_COLORS = np.array([[0, 0, 0], [0, 0, 255], [255, 0, 0]], dtype=np.uint8)
+GRID_COLOR = np.array([48, 48, 48], dtype=np.uint8)
+PADDING_COLOR = np.array([16, 16, 16], dtype=np.uint8)
+
+
+def render_frames(
+    obs: np.ndarray,
+    num_planes: List[int],
+    cell_size: int = 16,
+    height: Optional[int] = None,
+    width: Optional[int] = None,
+    outline: float = 0.15,
+) -> np.ndarray:
+    """Draws the one-hot observations `obs` (num_envs, h, w, sum(num_planes)) as uint8 RGB frames.
+
+    Frames are `cell_size` pixels per cell, or exactly `height` x `width` pixels when given,
+    in which case cells are scaled by nearest neighbour. `outline` is the width of the owner
+    outline as a fraction of a cell.
+    """
+    offsets = np.cumsum([0] + list(num_planes))
+    # cells outside the map of a padded env have no plane set at all
+    valid = obs[..., offsets[3]:offsets[4]].any(-1)
+    return render_planes(onehot_to_planes(obs, num_planes), cell_size, height, width, outline, valid)
+
+
+def render_planes(
+    planes: np.ndarray,
+    cell_size: int = 16,
+    height: Optional[int] = None,
+    width: Optional[int] = None,
+    outline: float = 0.15,
+    valid: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Draws observations given as feature indices (num_envs, h, w, len(num_planes)), see
+    `render_frames`. Cells where the bool array `valid` (num_envs, h, w) is False are padding.
+    """
+    num_envs, h, w, _ = planes.shape
+    owner = planes[..., 2].astype(np.int64)
+    unit = np.minimum(planes[..., 3], len(UNIT_COLORS) - 1)
+    cell_colors = UNIT_COLORS[unit]
+    if valid is not None:
+        cell_colors[~valid] = PADDING_COLOR
+
+    # for every output pixel, the cell it shows and its relative position inside that cell
+    rows, row_frac = _pixel_cells(height or h * cell_size, h)
+    cols, col_frac = _pixel_cells(width or w * cell_size, w)
+    frames = cell_colors[:, rows[:, None], cols[None, :]]
+
+    edge = ((row_frac < outline) | (row_frac >= 1 - outline))[:, None] | ((col_frac < outline) | (col_frac >= 1 - outline))[None, :]
+    pixel_owner = owner[:, rows[:, None], cols[None, :]]
+    outlined = edge & (pixel_owner > 0)
+    frames[outlined] = OWNER_COLORS[pixel_owner[outlined]]
+
+    grid = _first_pixels(rows)[:, None] | _first_pixels(cols)[None, :]
+    frames[:, grid] = GRID_COLOR
+    return frames
+
+
+def mosaic(frames: np.ndarray, columns: Optional[int] = None, spacing: int = 2) -> np.ndarray:
+    """Tiles frames (n, height, width, 3) into one image with `columns` frames per row.
+
+    By default the mosaic is about square. Missing tiles of the last row and the `spacing`
+    between tiles are black.
+    """
+    n, height, width, channels = frames.shape
+    columns = columns or int(np.ceil(np.sqrt(n)))
+    rows = -(-n // columns)
+    tiles = np.zeros((rows * columns, height + spacing, width + spacing, channels), dtype=frames.dtype)
+    tiles[:n, :height, :width] = frames
+    image = tiles.reshape(rows, columns, height + spacing, width + spacing, channels).transpose(0, 2, 1, 3, 4)
+    image = image.reshape(rows * (height + spacing), columns * (width + spacing), channels)
+    return image[:image.shape[0] - spacing, :image.shape[1] - spacing]
+
+
+def _pixel_cells(pixels: int, cells: int):
+    "Returns the cell index and the position in [0, 1) inside that cell of every pixel."
+    position = np.arange(pixels) * cells / pixels
+    index = position.astype(np.int64)
+    return index, position - index
+
+
+def _first_pixels(index: np.ndarray) -> np.ndarray:
+    return np.r_[True, index[1:] != index[:-1]]
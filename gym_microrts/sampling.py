@@ -0,0 +1,78 @@
+"""Vectorized sampling of valid gridnet actions from the action masks."""
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+class MaskedMultiDiscreteSampler:
+    """Samples an action for every cell of every env in one call, e.g.
+
+        sampler = MaskedMultiDiscreteSampler(env.action_space.nvec)
+        actions = sampler.sample(env.get_action_mask())
+        env.step(actions)
+
+    `nvec` is the `action_space.nvec` of the env: a source unit followed by the action
+    components. The 78 values of the mask after the source unit are the valid values of each
+    component, laid out one after another as in `nvec[1:]`. Every component is drawn
+    independently by inverse-CDF sampling, uniformly among its valid values or from the
+    softmax of the given logits. Components without any valid value, e.g. the produce unit
+    type of a unit that cannot produce, are set to 0 like the cells without a source unit.
+    """
+
+    def __init__(self, nvec: Sequence[int], seed: Optional[int] = None):
+        self.nvec = np.asarray(nvec[1:])
+        self.starts = np.cumsum(np.r_[0, self.nvec[:-1]])
+        # component of each of the mask values after the source unit
+        self._component = np.repeat(np.arange(len(self.nvec)), self.nvec)
+        self.rng = np.random.default_rng(seed)
+
+    def seed(self, seed: Optional[int] = None) -> None:
+        self.rng = np.random.default_rng(seed)
+
+    def sample(
+        self,
+        mask: np.ndarray,
+        logits: Optional[np.ndarray] = None,
+        log_prob: bool = False,
+    ) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """Returns (num_envs, h * w, len(nvec) - 1) int32 actions for the (num_envs, h, w, 79) `mask`.
+
+        `logits` of shape (num_envs, h, w, 78) (or (num_envs, h * w, 78)) weight the valid
+        values, the default is uniform. With `log_prob=True` the (num_envs, h * w) log
+        probability of the sampled action of every cell is returned too, 0 for cells without
+        a source unit.
+        """
+        num_envs = mask.shape[0]
+        mask = mask.reshape(num_envs, -1, mask.shape[-1])
+        source_unit = mask[..., 0].astype(np.bool_)
+        valid = mask[..., 1:].astype(np.bool_)
+
+        if logits is None:
+            weights = valid.astype(np.float64)
+            log_weights = np.zeros(weights.shape)
+        else:
+            logits = np.where(valid, logits.reshape(valid.shape), -np.inf)
+            component_max = np.maximum.reduceat(logits, self.starts, axis=-1)
+            component_max[~np.isfinite(component_max)] = 0
+            log_weights = logits - component_max[..., self._component]
+            weights = np.exp(log_weights)
+
+        # cumulative weight inside each component, and the total weight of each component
+        cumulative = np.cumsum(weights, axis=-1)
+        offsets = np.concatenate((np.zeros(cumulative.shape[:-1] + (1,)), cumulative[..., self.starts[1:] - 1]), axis=-1)
+        cumulative -= offsets[..., self._component]
+        totals = cumulative[..., self.starts + self.nvec - 1]
+
+        threshold = self.rng.random(totals.shape) * totals
+        below = cumulative <= threshold[..., self._component]
+        actions = np.add.reduceat(below, self.starts, axis=-1, dtype=np.int32)
+        empty = totals <= 0
+        actions[empty] = 0
+        actions[~source_unit] = 0
+        if not log_prob:
+            return actions
+
+        chosen = np.take_along_axis(log_weights, self.starts + actions, axis=-1)
+        log_probs = np.where(empty, 0.0, chosen - np.log(np.where(empty, 1.0, totals))).sum(-1)
+        log_probs[~source_unit] = 0
+        return actions, log_probs
@@ -0,0 +1,178 @@
+"""Binary encodings of observations, steps and actions for the API server.
+
+Arrays are exchanged either as numpy `.npz`/`.npy` files or as msgpack maps where every
+array is a `{"dtype", "shape", "data"}` entry. msgpack is optional and only needed when a
+client asks for it.
+
+Observations can also be sent as deltas: only the cells that changed since a frame the
+client acknowledged, see `DeltaEncoder`. Clients rebuild the dense observations with
+`DeltaDecoder`.
+"""
+import io
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = "application/json"
+NPY = "application/x-npy"
+NPZ = "application/x-npz"
+MSGPACK = "application/msgpack"
+BINARY_TYPES = (NPZ, NPY, MSGPACK)
+OBS_FORMATS = ("uint8", "packed")
+
+
+def negotiate(accept: Optional[str]) -> str:
+    "Picks the response media type from an `Accept` header, JSON unless a binary type is listed."
+    for media_type in (accept or "").split(","):
+        media_type = media_type.split(";")[0].strip()
+        if media_type in (NPZ, MSGPACK):
+            return media_type
+    return JSON
+
+
+def encode_observation(obs: numpy.ndarray, obs_format: str = "uint8") -> Dict[str, numpy.ndarray]:
+    """Compacts a one-hot observation into `uint8` or, with `packed`, bit-packs its last axis.
+
+    Packed observations carry `obs_planes`, the length of the last axis to pass as `count`
+    to `numpy.unpackbits`.
+    """
+    if obs_format not in OBS_FORMATS:
+        raise ValueError(f"Unknown observation format '{obs_format}', expected one of {OBS_FORMATS}")
+    if obs_format == "packed":
+        return {"observation": numpy.packbits(obs.astype(numpy.uint8), axis=-1),
+                "obs_planes": numpy.array(obs.shape[-1])}
+    return {"observation": obs.astype(numpy.uint8)}
+
+
+def encode_arrays(arrays: Dict[str, numpy.ndarray], media_type: str, compress: bool = False) -> Tuple[bytes, Dict[str, str]]:
+    "Serializes named arrays, returns the body and the headers to send along."
+    headers = {}
+    if media_type == NPZ:
+        buffer = io.BytesIO()
+        (numpy.savez_compressed if compress else numpy.savez)(buffer, **arrays)
+        return buffer.getvalue(), headers
+    if media_type == MSGPACK:
+        body = _require_msgpack().packb({
+            name: {"dtype": arr.dtype.str, "shape": list(arr.shape), "data": arr.tobytes()}
+            for name, arr in ((name, numpy.ascontiguousarray(arr)) for name, arr in arrays.items())
+        })
+        if compress:
+            body = zlib.compress(body)
+            headers["Content-Encoding"] = "deflate"
+        return body, headers
+    raise ValueError(f"Unsupported media type '{media_type}'")
+
+
+def decode_arrays(body: bytes, media_type: str, content_encoding: Optional[str] = None) -> Dict[str, numpy.ndarray]:
+    "Inverse of `encode_arrays`. A bare `.npy` body is returned under the `actions` key."
+    if content_encoding == "deflate":
+        body = zlib.decompress(body)
+    if media_type == NPY:
+        return {"actions": numpy.load(io.BytesIO(body), allow_pickle=False)}
+    if media_type == NPZ:
+        with numpy.load(io.BytesIO(body), allow_pickle=False) as npz:
+            return {name: npz[name] for name in npz.files}
+    if media_type == MSGPACK:
+        return {
+            name: numpy.frombuffer(item["data"], dtype=item["dtype"]).reshape(item["shape"])
+            for name, item in _require_msgpack().unpackb(body).items()
+        }
+    raise ValueError(f"Unsupported media type '{media_type}'")
+
+
+def decode_actions(body: bytes, media_type: str, content_encoding: Optional[str] = None) -> Any:
+    "Decodes the actions of one env, see `actions_from_array`."
+    return actions_from_array(decode_arrays(body, media_type, content_encoding)["actions"])
+
+
+def actions_from_array(actions: numpy.ndarray) -> Any:
+    """Converts an array of actions of one env into what `env.step` expects for it.
+
+    Arrays of shape (num_units, 8) are per-unit actions and are returned as lists, arrays with
+    7 values in the last axis are dense gridnet actions for every cell and stay numpy arrays.
+    """
+    if actions.ndim == 2 and actions.shape[-1] == 8:
+        return actions.tolist()
+    return actions.astype(numpy.int32)
+
+
+class DeltaEncoder:
+    """Encodes the observations sent to one client relative to a frame it acknowledged.
+
+    Every encoded observation is a frame with a `frame_id`. A keyframe holds the full
+    `observation`; a delta frame holds `delta_indices`, the flat index of every changed cell,
+    i.e. `(env * height + y) * width + x`, `delta_values`, the new last axis of these cells,
+    and `base_frame_id`, the frame it applies to. Keyframes are sent when asked for, when the
+    acknowledged frame is unknown, and at least every `keyframe_interval` frames. The last
+    `history` frames are kept to compute deltas against.
+    """
+
+    def __init__(self, keyframe_interval: int = 100, history: int = 8):
+        self.keyframe_interval = keyframe_interval
+        self.history = history
+        self.frame_id = 0
+        self.last_keyframe_id = 0
+        self._frames: "OrderedDict[int, numpy.ndarray]" = OrderedDict()
+
+    def encode(self, obs: numpy.ndarray, ack: Optional[int] = None, keyframe: bool = False) -> Dict[str, numpy.ndarray]:
+        self.frame_id += 1
+        base = self._frames.get(ack) if ack is not None else None
+        if keyframe or base is None or base.shape != obs.shape or self.frame_id - self.last_keyframe_id >= self.keyframe_interval:
+            self.last_keyframe_id = self.frame_id
+            arrays = {"observation": obs, "frame_id": numpy.array(self.frame_id)}
+        else:
+            cells = obs.reshape(-1, obs.shape[-1])
+            changed = numpy.flatnonzero((cells != base.reshape(cells.shape)).any(-1)).astype(numpy.int32)
+            arrays = {
+                "delta_indices": changed,
+                "delta_values": cells[changed],
+                "base_frame_id": numpy.array(ack),
+                "frame_id": numpy.array(self.frame_id),
+            }
+        self._frames[self.frame_id] = obs.copy()
+        while len(self._frames) > self.history:
+            self._frames.popitem(last=False)
+        return arrays
+
+
+class DeltaDecoder:
+    """Client side of `DeltaEncoder`, rebuilds dense observations from keyframes and deltas, e.g.
+
+        decoder = DeltaDecoder()
+        response = requests.post(f"{url}/env/step", params={"delta": "true", "ack": decoder.ack}, ...)
+        obs = decoder.decode(decode_arrays(response.content, NPZ))
+
+    `ack` is the ID of the last decoded frame, to be sent with the next request, or None
+    before the first one.
+    """
+
+    def __init__(self, history: int = 8):
+        self.history = history
+        self.ack: Optional[int] = None
+        self._frames: "OrderedDict[int, numpy.ndarray]" = OrderedDict()
+
+    def decode(self, arrays: Dict[str, numpy.ndarray]) -> numpy.ndarray:
+        "Returns the dense observation of a frame. Raises KeyError if its base frame is unknown."
+        if "delta_indices" in arrays:
+            obs = self._frames[int(arrays["base_frame_id"])].copy()
+            obs.reshape(-1, obs.shape[-1])[arrays["delta_indices"]] = arrays["delta_values"]
+        else:
+            obs = numpy.array(arrays["observation"])
+        self.ack = int(arrays["frame_id"])
+        self._frames[self.ack] = obs
+        while len(self._frames) > self.history:
+            self._frames.popitem(last=False)
+        return obs
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise ValueError("msgpack is not installed on the server")
+    return msgpack
@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+
+class SessionLimitError(Exception):
+    "Raised when the registry already holds the maximum number of sessions."
+
+
+class Session:
+    """State of one environment served by the API.
+
+    `lock` serializes requests to the environment, `last_access` drives idle eviction.
+    `delta_encoders` hold the frames sent to a client asking for delta observations, one
+    per observation format.
+    """
+
+    def __init__(self, env_id: str, env: Any):
+        self.env_id = env_id
+        self.env = env
+        self.last_step: Any = None
+        self.last_actions: Any = None
+        self.delta_encoders: Dict[str, Any] = {}
+        self.lock = threading.RLock()
+        self.last_access = time.monotonic()
+
+    def touch(self) -> None:
+        self.last_access = time.monotonic()
+
+    def close(self) -> None:
+        "Closes the Java clients of the environment, the shared JVM keeps running."
+        with self.lock:
+            self.env.close(shutdown_jvm=False)
+
+
+class SessionRegistry:
+    """Environments of the API keyed by their ID.
+
+    All environments live in this process and so share one JVM. At most `max_sessions`
+    are kept, sessions unused for `idle_timeout` seconds are evicted and closed.
+    """
+
+    def __init__(self, max_sessions: int = 8, idle_timeout: float = 900.0):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.logger = logging.getLogger("SessionRegistry")
+        self._sessions: Dict[str, Session] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def ids(self) -> List[str]:
+        return list(self._sessions)
+
+    def sessions(self) -> List[Session]:
+        "Returns all sessions without counting as an access."
+        with self._lock:
+            return list(self._sessions.values())
+
+    def create(self, env: Any, env_id: Optional[str] = None) -> Session:
+        """Registers `env` under `env_id`, or a fresh ID, replacing any session with that ID.
+        Raises:
+            SessionLimitError if no slot is free even after evicting idle sessions.
+        """
+        self.evict_idle()
+        env_id = env_id or uuid.uuid4().hex
+        with self._lock:
+            replaced = self._sessions.pop(env_id, None)
+            if len(self._sessions) >= self.max_sessions:
+                if replaced is not None:
+                    self._sessions[env_id] = replaced
+                raise SessionLimitError(f"Maximum number of {self.max_sessions} environments reached")
+            session = self._sessions[env_id] = Session(env_id, env)
+        if replaced is not None:
+            replaced.close()
+        return session
+
+    def get(self, env_id: str) -> Session:
+        "Raises KeyError for unknown IDs."
+        session = self._sessions[env_id]
+        session.touch()
+        return session
+
+    def remove(self, env_id: str) -> None:
+        "Removes and closes a session. Raises KeyError for unknown IDs."
+        with self._lock:
+            session = self._sessions.pop(env_id)
+        session.close()
+
+    def evict_idle(self) -> List[str]:
+        "Closes sessions unused for longer than `idle_timeout` and returns their IDs."
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            evicted = [session for session in self._sessions.values() if session.last_access < deadline]
+            for session in evicted:
+                del self._sessions[session.env_id]
+        for session in evicted:
+            self.logger.info("Evicting idle environment %s", session.env_id)
+            session.close()
+        return [session.env_id for session in evicted]
+
+    def close_all(self) -> None:
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
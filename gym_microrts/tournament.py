@@ -0,0 +1,240 @@
+"""Round-robin tournaments between microRTS bots, played in parallel.
+
+Every pair of AIs meets on every map, on both sides, `games_per_side` times. Worker processes
+each run one `MicroRTSBotVecEnv` per map with `num_slots` games side by side, and a slot
+whose game finished is refilled with the next pending match right away, see
+`MicroRTSBotVecEnv.set_matchups`. Results are appended to a JSON lines file as the games
+finish, together with the Elo ratings after the game, e.g.
+
+    python -m gym_microrts.tournament --ais workerRushAI lightRushAI coacAI --num-workers 4
+
+Slots of a worker that ran out of matches keep playing until its last game finished, their
+games are not recorded.
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import traceback
+from typing import Callable, Dict, List, Optional
+
+import gym_microrts
+import numpy as np
+
+from gym_microrts import microrts_ai
+
+logger = logging.getLogger("Tournament")
+
+
+def round_robin(ai_names: List[str], map_paths: List[str], games_per_side: int = 1) -> List[Dict]:
+    "Returns the matches of every ordered pair of different AIs on every map."
+    return [
+        {"match_id": match_id, "ai1": ai1, "ai2": ai2, "map_path": map_path}
+        for match_id, (map_path, (ai1, ai2), _) in enumerate(
+            itertools.product(map_paths, itertools.permutations(ai_names, 2), range(games_per_side)))
+    ]
+
+
+class EloRatings:
+    """Elo ratings updated after every game, starting at `initial` with factor `k`."""
+
+    def __init__(self, k: float = 32.0, initial: float = 1500.0):
+        self.k = k
+        self.initial = initial
+        self.ratings: Dict[str, float] = {}
+
+    def __getitem__(self, name: str) -> float:
+        return self.ratings.get(name, self.initial)
+
+    def update(self, player1: str, player2: str, score1: float) -> None:
+        "`score1` is 1 if `player1` won, 0.5 for a draw and 0 if it lost."
+        rating1, rating2 = self[player1], self[player2]
+        expected1 = 1 / (1 + 10 ** ((rating2 - rating1) / 400))
+        self.ratings[player1] = rating1 + self.k * (score1 - expected1)
+        self.ratings[player2] = rating2 - self.k * (score1 - expected1)
+
+
+def _next_match(matches: List[Dict], counter) -> Optional[Dict]:
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    return matches[index] if index < len(matches) else None
+
+
+def _worker(worker_idx: int, matches_by_map: Dict[str, List[Dict]], counters: Dict, results, ais: List[Callable], num_slots: int, max_steps: int):
+    """Plays matches of every map until none is left and sends each result to `results`.
+
+    A `None` result signals that the worker is done.
+    """
+    from gym_microrts.envs.bot_vec_env import MicroRTSBotVecEnv
+    from gym_microrts.envs.jvm import launch_jvm
+
+    try:
+        # one JVM per worker, it needs the jars of all AIs of the tournament
+        launch_jvm(os.path.join(gym_microrts.__path__[0], "microrts"), ais)
+        factories = {ai.__name__: ai for ai in ais}
+        map_paths = list(matches_by_map)
+        # workers start on different maps so that small maps don't pile up
+        for map_path in map_paths[worker_idx % len(map_paths):] + map_paths[:worker_idx % len(map_paths)]:
+            matches, counter = matches_by_map[map_path], counters[map_path]
+            slots = [match for match in (_next_match(matches, counter) for _ in range(num_slots)) if match is not None]
+            if not slots:
+                continue
+            env = MicroRTSBotVecEnv(
+                ai1s=[factories[match["ai1"]] for match in slots],
+                ai2s=[factories[match["ai2"]] for match in slots],
+                max_steps=max_steps,
+                map_path=map_path,
+            )
+            env.reset()
+            lengths = np.zeros(len(slots), dtype=np.int64)
+            no_actions = [[] for _ in slots]
+            while any(match is not None for match in slots):
+                _, _, done, infos = env.step(no_actions)
+                lengths += 1
+                for slot in np.flatnonzero(done):
+                    match = slots[slot]
+                    if match is None:
+                        continue
+                    # the win/loss reward of player 0, i.e. ai1, is only non-zero at the end of a decided game
+                    win_loss = infos[slot]["raw_rewards"][0]
+                    results.put(dict(
+                        match,
+                        winner="ai1" if win_loss > 0 else "ai2" if win_loss < 0 else "draw",
+                        length=int(lengths[slot]),
+                        worker=worker_idx,
+                    ))
+                    lengths[slot] = 0
+                    slots[slot] = _next_match(matches, counter)
+                    if slots[slot] is not None:
+                        env.set_matchups([slot], [factories[slots[slot]["ai1"]]], [factories[slots[slot]["ai2"]]])
+            env.close(shutdown_jvm=False)
+    except Exception:
+        results.put({"error": traceback.format_exc(), "worker": worker_idx})
+    finally:
+        results.put(None)
+
+
+class Tournament:
+    """Plays `round_robin` matches of `ais` on `map_paths` in `num_workers` processes.
+
+    `ais` are factories of `microrts_ai`, or any other module-level factory that can be
+    pickled, with unique names. Every finished game is appended to `output` as one JSON line
+    with the match, the `winner` (`ai1`, `ai2` or `draw`), the game `length` in ticks and the
+    Elo ratings of both AIs after the game.
+    """
+
+    def __init__(
+        self,
+        ais: List[Callable],
+        map_paths: List[str],
+        games_per_side: int = 1,
+        num_workers: int = 2,
+        num_slots: int = 8,
+        max_steps: int = 2000,
+        output: str = "tournament.jsonl",
+        elo_k: float = 32.0,
+    ):
+        names = [ai.__name__ for ai in ais]
+        assert len(set(names)) == len(names), "AI factories need unique names"
+        self.ais = list(ais)
+        self.map_paths = list(map_paths)
+        self.games_per_side = games_per_side
+        self.num_workers = num_workers
+        self.num_slots = num_slots
+        self.max_steps = max_steps
+        self.output = output
+        self.elo = EloRatings(k=elo_k)
+        self.records = {name: {"wins": 0, "losses": 0, "draws": 0, "games": 0, "ticks": 0} for name in names}
+
+    def run(self) -> Dict[str, Dict]:
+        "Plays all matches and returns the standings, see `standings`."
+        matches = round_robin([ai.__name__ for ai in self.ais], self.map_paths, self.games_per_side)
+        matches_by_map = {map_path: [match for match in matches if match["map_path"] == map_path] for map_path in self.map_paths}
+        ctx = mp.get_context("spawn")
+        counters = {map_path: ctx.Value("i", 0) for map_path in self.map_paths}
+        results = ctx.Queue()
+        processes = [
+            ctx.Process(
+                target=_worker,
+                args=(worker_idx, matches_by_map, counters, results, self.ais, self.num_slots, self.max_steps),
+                daemon=True,
+            )
+            for worker_idx in range(self.num_workers)
+        ]
+        for process in processes:
+            process.start()
+
+        finished = 0
+        with open(self.output, "a") as f:
+            while finished < len(processes):
+                try:
+                    result = results.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(process.is_alive() for process in processes):
+                        logger.error("Workers exited without finishing the tournament")
+                        break
+                    continue
+                if result is None:
+                    finished += 1
+                elif "error" in result:
+                    logger.error("Worker %d failed:\n%s", result["worker"], result["error"])
+                else:
+                    f.write(json.dumps(self.record(result)) + "\n")
+                    f.flush()
+        for process in processes:
+            process.join()
+        return self.standings()
+
+    def record(self, result: Dict) -> Dict:
+        "Adds a finished game to the ratings and records, returns it with the new ratings."
+        ai1, ai2 = result["ai1"], result["ai2"]
+        score1 = {"ai1": 1.0, "ai2": 0.0, "draw": 0.5}[result["winner"]]
+        self.elo.update(ai1, ai2, score1)
+        for name, score in ((ai1, score1), (ai2, 1 - score1)):
+            record = self.records[name]
+            record["wins" if score == 1 else "losses" if score == 0 else "draws"] += 1
+            record["games"] += 1
+            record["ticks"] += result["length"]
+        return dict(result, elo_ai1=self.elo[ai1], elo_ai2=self.elo[ai2])
+
+    def standings(self) -> Dict[str, Dict]:
+        "Returns the record, Elo rating and mean game length of every AI, best first."
+        standings = {
+            name: dict(record, elo=self.elo[name], mean_length=record["ticks"] / record["games"] if record["games"] else 0.0)
+            for name, record in self.records.items()
+        }
+        return dict(sorted(standings.items(), key=lambda item: -item[1]["elo"]))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ais", nargs="+", default=[ai.__name__ for ai in microrts_ai.ALL_AIS],
+                        help="names of the AIs in `microrts_ai`")
+    parser.add_argument("--map-paths", nargs="+", default=["maps/16x16/basesWorkers16x16.xml"])
+    parser.add_argument("--games-per-side", type=int, default=1)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--num-slots", type=int, default=8, help="games played side by side by each worker")
+    parser.add_argument("--max-steps", type=int, default=2000)
+    parser.add_argument("--output", default="tournament.jsonl")
+    args = parser.parse_args(argv)
+
+    tournament = Tournament(
+        ais=[getattr(microrts_ai, name) for name in args.ais],
+        map_paths=args.map_paths,
+        games_per_side=args.games_per_side,
+        num_workers=args.num_workers,
+        num_slots=args.num_slots,
+        max_steps=args.max_steps,
+        output=args.output,
+    )
+    for name, standing in tournament.run().items():
+        print(f"{name:20s} elo={standing['elo']:7.1f} W/L/D={standing['wins']}/{standing['losses']}/{standing['draws']} "
+              f"mean_length={standing['mean_length']:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,44 @@ def to_list(obj: object) -> List:
 def to_numpy(l: List) -> numpy.ndarray:
     return numpy.array(l)
 
+def java_to_numpy(obj: Any, dtype=None, shape=None) -> numpy.ndarray:
+    """Converts a Java primitive array or direct `java.nio` buffer into a numpy array of `shape`.
+
+    Both expose the buffer protocol through JPype: direct buffers are wrapped without copying
+    and rectangular primitive arrays are transferred in bulk. Anything else, e.g. ragged
+    nested arrays, falls back to the element by element conversion of `numpy.array`.
+    Direct buffers are flat, so callers pass the `shape` of the data they hold.
+    """
+    if hasattr(obj, "isDirect") and obj.isDirect():
+        view = memoryview(obj)
+        dtype = numpy.dtype(dtype or view.format)
+        if str(obj.order()) == "BIG_ENDIAN":
+            dtype = dtype.newbyteorder(">")
+        arr = numpy.frombuffer(view, dtype=dtype)
+    else:
+        try:
+            arr = numpy.asarray(memoryview(obj))
+        except (TypeError, ValueError, BufferError):
+            arr = numpy.array(obj)
+        if dtype is not None:
+            arr = arr.astype(dtype, copy=False)
+    return arr if shape is None else arr.reshape(shape)
+
+def onehot_to_planes(obs: numpy.ndarray, num_planes: List[int]) -> numpy.ndarray:
+    "Turns one-hot observations (..., sum(num_planes)) into the index of each feature (..., len(num_planes))."
+    offsets = numpy.cumsum([0] + list(num_planes))
+    planes = numpy.empty(obs.shape[:-1] + (len(num_planes),), dtype=numpy.uint8)
+    for i in range(len(num_planes)):
+        planes[..., i] = obs[..., offsets[i]:offsets[i + 1]].argmax(-1)
+    return planes
+
+def planes_to_onehot(planes: numpy.ndarray, num_planes: List[int], dtype=numpy.uint8) -> numpy.ndarray:
+    "Inverse of `onehot_to_planes`."
+    offsets = numpy.cumsum([0] + list(num_planes[:-1]))
+    obs = numpy.zeros(planes.shape[:-1] + (sum(num_planes),), dtype=dtype)
+    numpy.put_along_axis(obs, planes.astype(numpy.int64) + offsets, 1, axis=-1)
+    return obs
+
 def extract_space_info(space) -> Dict[str, Any]:
     if isinstance(space, gym.spaces.multi_discrete.MultiDiscrete):
         return dict(dtype=str(space.dtype), shape=to_list(space.nvec))
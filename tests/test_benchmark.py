@@ -0,0 +1,22 @@
+import math
+
+from gym_microrts.benchmark import PHASES, compare, run_benchmark
+
+
+def test_run_benchmark_stub():
+    result = run_benchmark(num_bot_envs=2, map_path="maps/8x8/basesWorkers8x8.xml", num_steps=5, warmup_steps=1, stub=True)
+    assert result["config"]["stub"]
+    assert result["sps"] > 0
+    assert set(result["phase_ms"]) == set(PHASES)
+    assert all(not math.isnan(ms) for ms in result["phase_ms"].values())
+
+
+def test_compare():
+    config = {"num_selfplay_envs": 0, "num_bot_envs": 2, "map_path": "maps/8x8/basesWorkers8x8.xml",
+              "partial_obs": False, "ai": "coacAI", "stub": True}
+    other = dict(config, num_bot_envs=4)
+    baseline = [{"config": config, "sps": 1000.0}]
+    assert compare([{"config": config, "sps": 950.0}], baseline, tolerance=0.1) == []
+    regressions = compare([{"config": config, "sps": 800.0}, {"config": other, "sps": 1.0}], baseline, tolerance=0.1)
+    assert len(regressions) == 1
+    assert "bots=2" in regressions[0] and "-20.0%" in regressions[0]